@@ -24,6 +24,8 @@ class Settings:
                 if 'choices' in metadata and metadata['choices']:
                     path_to_class = metadata['choices']
                     metadata['choices'] = self.__get_object(path_to_class)
+                    # looked up by label for every document pulled from OpenKM
+                    metadata['choice_index'] = utils.ChoiceIndex(metadata['choices'], metadata.get('fold_case', False))
 
     def __get_object(self, path_to_class):
         class_name = self.__extract_class_name(path_to_class)
@@ -36,4 +38,9 @@ class Settings:
     def __reconstruct_module_path(self, path_to_class):
         return '.'.join(path_to_class.split('.')[:-1])
 
-Settings()
\ No newline at end of file
+Settings()
+
+if settings.OPENKM['configuration'].get('PreloadWsdls', False):
+    # parse every WSDL at startup rather than on the first request that needs it
+    import client
+    client.registry.warm()
@@ -0,0 +1,321 @@
+"""
+Caches used to avoid repeating OpenKM web service calls
+"""
+import os
+import time
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+from functools import wraps
+from collections import OrderedDict
+
+from django.conf import settings
+
+from suds.sudsobject import Object
+
+
+class LocalMetadataCache(object):
+    """
+    In-process metadata cache with a time to live and least recently used eviction
+    """
+
+    def __init__(self, timeout=300, max_entries=1000):
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            # re-insert to mark the entry as the most recently used
+            self._entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.timeout, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoMetadataCache(object):
+    """
+    Metadata cache stored in one of the Django CACHES, so it can be shared between processes.
+    Eviction is left to the cache backend.  suds objects can't be pickled, so they are stored
+    as CachedObject snapshots.  Keys include a version number held in the cache, which clear()
+    increments so every process stops reading the old entries
+    """
+    VERSION_KEY = 'openkm:version'
+    # memcached's longest relative timeout
+    VERSION_TIMEOUT = 30 * 24 * 60 * 60
+
+    def __init__(self, alias='default', timeout=300):
+        from django.core.cache import get_cache
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def get(self, key):
+        return self.cache.get(self._make_key(key))
+
+    def set(self, key, value):
+        self.cache.set(self._make_key(key), freeze(value), self.timeout)
+
+    def delete(self, key):
+        self.cache.delete(self._make_key(key))
+
+    def clear(self):
+        try:
+            self.cache.incr(self.VERSION_KEY)
+        except ValueError:
+            # no version yet, or it was evicted; _get_version starts a new one
+            self._get_version()
+
+    def _get_version(self):
+        version = self.cache.get(self.VERSION_KEY)
+        if version is None:
+            # starting from the time, rather than 1, keeps clear of versions used before an eviction
+            self.cache.add(self.VERSION_KEY, int(time.time()), self.VERSION_TIMEOUT)
+            version = self.cache.get(self.VERSION_KEY) or int(time.time())
+        return version
+
+    def _make_key(self, key):
+        # paths may be longer than, or contain characters not allowed in, memcached keys
+        return 'openkm:%s:%s' % (self._get_version(), hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+class CachedObject(dict):
+    """
+    Picklable snapshot of a suds object which supports the same attribute access
+    """
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def freeze(value):
+    """ Recursively converts suds objects to CachedObjects """
+    if isinstance(value, Object):
+        return CachedObject((name, freeze(item)) for name, item in value)
+    if isinstance(value, list):
+        return [freeze(item) for item in value]
+    return value
+
+
+class MetadataCache(object):
+    """
+    Caches document paths by UUID and document properties by path, in front of
+    client.Document.get_path, client.Document.get_properties and client.Repository.get_path.
+    Values returned from the cache are shared, so treat them as read only.
+    :param backend: object with get(key), set(key, value) and delete(key), eg. LocalMetadataCache
+    """
+    PATH = 'path'
+    PROPERTIES = 'properties'
+    UUID = 'uuid'
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, kind, key):
+        return self.backend.get(self._make_key(kind, key))
+
+    def set(self, kind, key, value):
+        self.backend.set(self._make_key(kind, key), value)
+        if kind == self.PATH:
+            # remember the reverse mapping so the entry can be invalidated by path
+            self.backend.set(self._make_key(self.UUID, value), key)
+
+    def invalidate(self, path):
+        """ Forget everything cached about the node at path """
+        self.backend.delete(self._make_key(self.PROPERTIES, path))
+        uuid = self.backend.get(self._make_key(self.UUID, path))
+        if uuid:
+            self.backend.delete(self._make_key(self.PATH, uuid))
+            self.backend.delete(self._make_key(self.UUID, path))
+
+    def _make_key(self, kind, key):
+        return u'%s:%s' % (kind, key)
+
+
+class ContentCache(object):
+    """
+    On-disk cache of decoded document bodies, keyed by document UUID and version, so a version
+    is only fetched from OpenKM once.  Bodies are written to a temporary file and renamed into
+    place when complete, and the least recently used are removed once the cache holds more
+    than max_size bytes
+    """
+    TEMP_PREFIX = '.tmp-'
+
+    def __init__(self, root, max_size=1024 ** 3, file_mode=0644):
+        """
+        :param file_mode: permissions of the cached files, readable by other users by default so a
+        front end server running as another user can send them
+        """
+        self.root = root
+        self.max_size = max_size
+        self.file_mode = file_mode
+        self._lock = threading.Lock()
+        try:
+            os.makedirs(root)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get_path(self, uuid, version):
+        key = u'%s:%s' % (uuid, version)
+        return os.path.join(self.root, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def open(self, uuid, version):
+        """
+        :returns the cached body opened for reading, or None on a miss
+        """
+        path = self.get_path(uuid, version)
+        try:
+            file_obj = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            # the modification time records when the entry was last used
+            os.utime(path, None)
+        except OSError:
+            pass
+        return file_obj
+
+    def store(self, uuid, version, blocks):
+        """
+        Passes a stream of blocks through unchanged while writing it to the cache.  The entry
+        is only added once the stream has been read to the end
+        :param blocks: iterable of binary strings
+        :return generator of binary strings
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix=self.TEMP_PREFIX)
+        complete = False
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for block in blocks:
+                    temp_file.write(block)
+                    yield block
+            # mkstemp creates the file readable by its owner only
+            os.chmod(temp_path, self.file_mode)
+            os.rename(temp_path, self.get_path(uuid, version))
+            complete = True
+        finally:
+            if not complete:
+                self._remove(temp_path)
+        self.evict()
+
+    def fill(self, uuid, version, blocks):
+        """
+        Reads a whole stream into the cache
+        :returns the cached body opened for reading
+        """
+        for block in self.store(uuid, version, blocks):
+            pass
+        return self.open(uuid, version)
+
+    def evict(self):
+        """ Removes the least recently used bodies until the cache is within max_size """
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.root):
+                if name.startswith(self.TEMP_PREFIX):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+            total = sum(size for mtime, size, name in entries)
+            for mtime, size, name in sorted(entries):
+                if total <= self.max_size:
+                    break
+                self._remove(os.path.join(self.root, name))
+                total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            logging.debug('Could not remove %s: %s', path, e)
+
+
+def get_content_cache():
+    """
+    Builds the content cache configured in settings, or returns None if it is disabled
+    """
+    configuration = settings.OPENKM['configuration']
+    if not configuration.get('ContentCacheRoot'):
+        return None
+    return ContentCache(configuration['ContentCacheRoot'], configuration.get('ContentCacheMaxSize', 1024 ** 3),
+                        configuration.get('ContentCacheFileMode', 0644))
+
+
+def get_metadata_cache():
+    """
+    Builds the metadata cache configured in settings, or returns None if it is disabled
+    """
+    configuration = settings.OPENKM['configuration']
+    timeout = configuration.get('MetadataCacheTimeout')
+    if not timeout:
+        return None
+    if configuration.get('MetadataCacheBackend'):
+        backend = DjangoMetadataCache(configuration['MetadataCacheBackend'], timeout)
+    else:
+        backend = LocalMetadataCache(timeout, configuration.get('MetadataCacheSize', 1000))
+    return MetadataCache(backend)
+
+
+metadata = get_metadata_cache()
+content = get_content_cache()
+
+
+def cached(kind):
+    """
+    Decorator for client methods taking a single uuid or path, which caches the result in
+    the service's metadata_cache when one is configured
+    """
+    def decorator(fn):
+        def wrapped(self, key):
+            if self.metadata_cache is None:
+                return fn(self, key)
+            value = self.metadata_cache.get(kind, key)
+            if value is None:
+                value = fn(self, key)
+                if value is not None:
+                    self.metadata_cache.set(kind, key, value)
+            return value
+        return wraps(fn)(wrapped)
+    return decorator
+
+
+def invalidates(fn):
+    """
+    Decorator for client methods whose first argument is the path of a node they change
+    """
+    def wrapped(self, path, *args, **kwargs):
+        try:
+            return fn(self, path, *args, **kwargs)
+        finally:
+            if self.metadata_cache is not None:
+                self.metadata_cache.invalidate(path)
+    return wraps(fn)(wrapped)
@@ -1,12 +1,13 @@
-import sys, logging
+import sys, logging, threading, atexit
 from functools import wraps
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 
 from suds import WebFault
 from suds.client import Client
 
-import exceptions
+import cache, exceptions, transport
 
 logging.getLogger('suds.client').setLevel(logging.INFO)
 
@@ -40,27 +41,334 @@ def try_except(fn):
             raise exception, exception(e), tb
     return wraps(fn)(wrapped)
 
+class ClientRegistry(object):
+    """
+    Process-wide cache of suds Clients, keyed by service name.
+    Each WSDL is fetched and parsed once; callers are handed a clone which shares the parsed
+    WSDL but has its own options and transport, so clones may be used independently
+    """
+
+    def __init__(self, wsdls):
+        self.wsdls = wsdls
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def get(self, class_name):
+        """
+        :param class_name: string key of OPENKM_WSDLS eg. 'Document'
+        :returns a cheap clone of the cached Client
+        """
+        return self._get_cached_client(class_name).clone()
+
+    def _get_cached_client(self, class_name):
+        try:
+            return self._clients[class_name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            # another thread may have parsed the WSDL while we waited for the lock
+            if class_name not in self._clients:
+                self._clients[class_name] = Client(self.wsdls[class_name], transport=transport.StreamingTransport())
+            return self._clients[class_name]
+
+    def warm(self, class_names=None):
+        """
+        Parses the WSDLs up front, eg. when Django starts, so the first request doesn't pay for it
+        :param class_names: iterable of service names, defaults to all of OPENKM_WSDLS
+        """
+        for class_name in class_names or self.wsdls.keys():
+            self._get_cached_client(class_name)
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+
+
+registry = ClientRegistry(OPENKM_WSDLS)
+
 def get_service(class_name):
-    return Client(OPENKM_WSDLS[class_name]).service
+    return registry.get(class_name).service
 
 def get_client(class_name):
-    return Client(OPENKM_WSDLS[class_name])
+    return registry.get(class_name)
+
+class SessionPool(object):
+    """
+    Shares a small pool of OpenKM session tokens per user between service objects and threads,
+    rather than logging in once for every service object.  Tokens are handed out round-robin
+    and are logged out when the process exits
+    """
+
+    def __init__(self, size=2):
+        self.size = size
+        self._sessions = {}
+        self._counters = {}
+        # number of logins in progress per user, each holding one of the user's slots
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._logged_in = threading.Condition(self._lock)
+
+    def get_token(self, user=None, password=None):
+        """
+        Logs in outside the lock, so a slow login doesn't hold up threads which can be given
+        a pooled token, or which are logging in as another user
+        """
+        user, password = self._get_credentials(user, password)
+        with self._lock:
+            while True:
+                sessions = self._sessions.setdefault(user, [])
+                pending = self._pending.get(user, 0)
+                if len(sessions) + pending < self.size:
+                    self._pending[user] = pending + 1
+                    break
+                if sessions:
+                    index = self._counters.get(user, 0)
+                    self._counters[user] = index + 1
+                    return sessions[index % len(sessions)].token
+                # every slot is being logged in by another thread
+                self._logged_in.wait()
+
+        auth = None
+        try:
+            auth = self._login(user, password)
+        finally:
+            with self._lock:
+                self._pending[user] -= 1
+                if auth is not None:
+                    self._sessions.setdefault(user, []).append(auth)
+                self._logged_in.notify_all()
+        return auth.token
+
+    def renew(self, stale_token, user=None, password=None):
+        """
+        Replaces an expired token with a new login.  Other holders of the same stale token
+        who call renew() afterwards are given a current token without logging in again
+        :param stale_token: string the token OpenKM rejected
+        :returns string
+        """
+        user, password = self._get_credentials(user, password)
+        with self._lock:
+            sessions = self._sessions.get(user, [])
+            stale = [auth for auth in sessions if auth.token == stale_token]
+            for auth in stale:
+                sessions.remove(auth)
+        for auth in stale:
+            self._logout(auth)
+        token = self.get_token(user, password)
+        if stale:
+            logging.info('Renewed expired OpenKM session for %s', user)
+        return token
+
+    def close(self):
+        """ Logs out every pooled session """
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+            self._counters = {}
+        for user_sessions in sessions.values():
+            for auth in user_sessions:
+                self._logout(auth)
+
+    def _login(self, user, password):
+        auth = Auth()
+        auth.login(user=user, password=password)
+        return auth
+
+    def _logout(self, auth):
+        try:
+            auth.logout()
+        except Exception, e:
+            # the session may already have expired on the server
+            logging.debug('OpenKM logout failed: %s', e)
+
+    def _get_credentials(self, user, password):
+        if user is None:
+            user = settings.OPENKM['configuration']['User']
+            password = settings.OPENKM['configuration']['Password']
+        return user, password
+
+
+sessions = SessionPool(size=settings.OPENKM['configuration'].get('SessionPoolSize', 2))
+atexit.register(sessions.close)
 
 def get_token():
-    auth = Auth()
-    auth.login()
-    return auth.token
+    return sessions.get_token()
+
+
+class SessionService(object):
+    """
+    Wraps a suds service so that a call rejected because its session token has expired
+    is retried once with a token renewed through the session pool
+    """
+
+    def __init__(self, service, owner):
+        """
+        :param service: suds ServiceSelector
+        :param owner: the BaseService instance holding the token
+        """
+        self._service = service
+        self._owner = owner
+
+    def __getattr__(self, name):
+        method = getattr(self._service, name)
+
+        def call(*args, **kwargs):
+            return self.call(method, *args, **kwargs)
+
+        return call
+
+    def call(self, method, *args, **kwargs):
+        """
+        Calls method, renewing the session and retrying once if the token has expired
+        :param method: callable taking the same arguments as the suds method
+        """
+        token = self._owner.token
+        # the transport forgets streamed files once they've been sent, so keep them for the retry
+        transport = self._owner.client.options.transport
+        streams = transport.get_streams(list(args) + kwargs.values())
+        try:
+            return method(*args, **kwargs)
+        except WebFault, e:
+            if not exceptions.ExceptionParser().is_session_expired(e):
+                raise
+            self._owner.token = sessions.renew(token)
+            transport.restream(streams)
+            args, kwargs = self._replace_token(args, kwargs, token, self._owner.token)
+            return method(*args, **kwargs)
+
+    def _replace_token(self, args, kwargs, stale_token, token):
+        """ Tokens are passed either as the token keyword or as the first positional argument """
+        if kwargs.get('token') == stale_token:
+            kwargs['token'] = token
+        elif args and args[0] == stale_token:
+            args = (token,) + tuple(args[1:])
+        return args, kwargs
+
+
+class ServiceCounter(object):
+    """
+    Counts the service objects constructed in the current thread while it is active.
+    Useful to measure which services a code path actually touches, eg.
+
+        with client.ServiceCounter() as counter:
+            sync.DjangoToOpenKm().execute(document, FolderList)
+        print counter.total, counter.by_class
+    """
+    _local = threading.local()
+
+    def __init__(self):
+        self.by_class = {}
+
+    @property
+    def total(self):
+        return sum(self.by_class.values())
+
+    def __enter__(self):
+        self._get_active().append(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self._get_active().remove(self)
+
+    @classmethod
+    def record(cls, class_name):
+        for counter in cls._get_active():
+            counter.by_class[class_name] = counter.by_class.get(class_name, 0) + 1
+
+    @classmethod
+    def _get_active(cls):
+        if not hasattr(cls._local, 'counters'):
+            cls._local.counters = []
+        return cls._local.counters
+
+
+class LazyService(object):
+    """
+    Descriptor which builds a service (or facade) the first time the attribute is read,
+    then stores it on the instance so later reads are plain attribute lookups, eg.
+
+        class Keyword(object):
+            property = client.LazyService(client.Property)
+
+    :param factory: callable returning the object, usually a BaseService subclass
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = None
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = self.factory()
+        instance.__dict__[self._get_name(owner)] = value
+        return value
+
+    def _get_name(self, owner):
+        if self.name is None:
+            for klass in owner.__mro__:
+                names = [name for name, value in vars(klass).items() if value is self]
+                if names:
+                    self.name = names[0]
+                    break
+        return self.name
+
+
+class ServicePool(object):
+    """
+    A long lived pool of threads for making calls concurrently.  suds clients aren't thread safe,
+    so each thread builds its own service (or facade) the first time it's used and keeps it for
+    the life of the process, eg.
+
+        class Property(object):
+            group_pool = client.ServicePool(client.PropertyGroup, 4)
+
+    The threads are only started by the first call to map
+    :param factory: callable returning the object, usually a BaseService subclass
+    :param workers: int number of threads
+    """
+
+    def __init__(self, factory, workers):
+        self.factory = factory
+        self.workers = workers
+        self._local = threading.local()
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get_service(self):
+        """ :returns the calling thread's service """
+        if not hasattr(self._local, 'service'):
+            self._local.service = self.factory()
+        return self._local.service
+
+    def map(self, fn, items):
+        """
+        Calls fn(service, item) for each item on the pool's threads
+        :returns list of the results, in the order of items
+        """
+        return self._get_pool().map(lambda item: fn(self.get_service(), item), items)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+            return self._pool
 
 
 class BaseService(object):
 
+    # see cache.MetadataCache; None disables caching
+    metadata_cache = cache.metadata
+
     def __init__(self, start_session=True, class_name=None):
         if not class_name:
             class_name = self.__class__.__name__
-        self.service = get_service(class_name)
+        ServiceCounter.record(class_name)
         self.client = get_client(class_name)
+        self.service = self.client.service
         if start_session:
             self.token = get_token()
+            self.service = SessionService(self.service, self)
 
 
 class Auth(BaseService):
@@ -114,11 +422,21 @@ class Document(BaseService):
         """
             Create a new document in the repository.
             :param Document object (use self.new())
-            :param content Java byte[] compatible (use make_file_java_byte_array_compatible())
+            :param content Java byte[] compatible (use stream_content() or make_file_java_byte_array_compatible())
             :return A document object with the properties of the new created document.
             """
         return self.service.create(token=self.token, doc=doc, content=content)
 
+    def stream_content(self, file_obj):
+        """
+        Prepares a file to be uploaded by this instance without reading it into memory.
+        The file is base64 encoded block by block while the request is being sent
+        :param file_obj: file like object
+        :return content to pass to create(), set_content() or create_document() on this instance
+        """
+        return self.client.options.transport.stream(file_obj)
+
+    @cache.invalidates
     def delete(self, doc_path):
         """
         Removes a document from the repository and move it to the user trash.
@@ -128,6 +446,7 @@ class Document(BaseService):
         return self.service.delete(token=self.token, docPath=doc_path)
 
 
+    @cache.invalidates
     def lock(self, doc_path):
         """
         Lock a document, so only is editable by the locker.
@@ -137,6 +456,7 @@ class Document(BaseService):
         return self.service.lock(token=self.token, docPath=doc_path)
 
 
+    @cache.invalidates
     def unlock(self, doc_path):
         """
         Unlock a document, so will be editable for other users.
@@ -146,6 +466,7 @@ class Document(BaseService):
         return self.service.unlock(token=self.token, docPath=doc_path)
 
 
+    @cache.invalidates
     def rename(self, doc_path, new_name):
         """
         Rename a document in the repository.
@@ -156,6 +477,7 @@ class Document(BaseService):
         return self.service.rename(token=self.token, docPath=doc_path, newName=new_name)
 
 
+    @cache.invalidates
     def move(self, doc_path, new_name):
         """
         Move a document to another location in the repository.
@@ -166,6 +488,7 @@ class Document(BaseService):
         return self.service.move(token=self.token, docPath=doc_path, newName=new_name)
 
 
+    @cache.cached(cache.MetadataCache.PROPERTIES)
     def get_properties(self, doc_path):
         """
         Obtain document properties from the repository.
@@ -174,6 +497,16 @@ class Document(BaseService):
         """
         return self.service.getProperties(token=self.token, docPath=doc_path)
 
+    def get_current_properties(self, doc_path):
+        """
+        As get_properties, but always read from OpenKM, eg. before diffing against what is there.
+        The metadata cache is refreshed with the result
+        """
+        properties = self.service.getProperties(token=self.token, docPath=doc_path)
+        if self.metadata_cache is not None and properties is not None:
+            self.metadata_cache.set(cache.MetadataCache.PROPERTIES, doc_path, properties)
+        return properties
+
 
     def set_properties(self, doc):
         """
@@ -181,14 +514,17 @@ class Document(BaseService):
         :param doc Document object
         :return none
         """
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(doc.path)
         return self.service.setProperties(token=self.token, doc=doc)
 
 
+    @cache.invalidates
     def set_content(self, doc_path, content):
         """
         Set document content in the repository.
         :param doc_path string
-        :param content byte array (Java)
+        :param content byte array (Java), or the return value of stream_content()
         :return none
         """
         return self.service.setContent(token=self.token, docPath=doc_path, content=content)
@@ -202,6 +538,18 @@ class Document(BaseService):
         return self.service.getContent(token=self.token, docPath=doc_path, checkout=checkout)
 
 
+    def get_content_stream(self, doc_path, checkout=False):
+        """
+        Obtain document content as a generator of binary blocks.  The reply is parsed and
+        base64 decoded as it arrives, so the document is never held in memory
+        :param doc_path string
+        :param checkout boolean
+        """
+        method = transport.StreamingMethod(self.client.service.getContent)
+        reply = self.service.call(method, token=self.token, docPath=doc_path, checkout=checkout)
+        return transport.iter_base64_content(reply)
+
+
     def get_content_by_version(self, doc_path, version_id):
         """
         Obtain document content from the repository.
@@ -211,6 +559,7 @@ class Document(BaseService):
         return self.service.getContentByVersion(token=self.token, docPath=doc_path, versionId=version_id)
 
 
+    @cache.invalidates
     def checkout(self, doc_path):
         """
         Checkout the document to edit it. The document can't be edited by another user until it is checked in o the checkout is cancelled.
@@ -220,6 +569,7 @@ class Document(BaseService):
         return self.service.checkout(token=self.token, docPath=doc_path)
 
 
+    @cache.invalidates
     def cancel_checkout(self, doc_path):
         """
         Cancel a previous checked out state in a document.
@@ -229,6 +579,7 @@ class Document(BaseService):
         return self.service.cancelCheckout(token=self.token, docPath=doc_path)
 
 
+    @cache.invalidates
     def checkin(self, doc_path):
         """
         Check in the document to create a new version.
@@ -247,6 +598,7 @@ class Document(BaseService):
         return self.service.getVersionHistory(token=self.token, docPath=doc_path)
 
 
+    @cache.invalidates
     def restore_version(self, doc_path, version_id):
         """
         Revert the document to an specific previous version.
@@ -272,6 +624,7 @@ class Document(BaseService):
         return self.service.isValid(token=self.token, docPath=doc_path)
 
 
+    @cache.cached(cache.MetadataCache.PATH)
     def get_path(self, uuid):
         """
         The the document path from a UUID.
@@ -318,6 +671,8 @@ class Document(BaseService):
         """
         if not hasattr(self.service, 'updateDocument'):
             raise AttributeError('updateDocument is not available on your instance of OpenKM')
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(data.document.path)
         return self.service.updateDocument(token=self.token, data=data)
 
 
@@ -442,15 +797,19 @@ class Folder(BaseService):
 
 class Property(BaseService):
 
+    @cache.invalidates
     def add_category(self, node_path, category_uuid):
         return self.service.addCategory(self.token, nodePath=node_path, catId=category_uuid)
 
+    @cache.invalidates
     def remove_category(self, node_path, category_uuid):
         return self.service.removeCategory(token=self.token, nodePath=node_path, catId=category_uuid)
 
+    @cache.invalidates
     def add_keyword(self, node_path, keyword):
         return self.service.addKeyword(token=self.token, nodePath=node_path, keyword=keyword)
 
+    @cache.invalidates
     def remove_keyword(self, node_path, keyword):
         ''' Add a keyword to a document.  '''
         return self.service.removeKeyword(token=self.token, nodePath=node_path, keyword=keyword)
@@ -516,6 +875,7 @@ class Repository(BaseService):
         """ Test if a node path exists """
         return self.service.hasNode(token=self.token, path=path)
 
+    @cache.cached(cache.MetadataCache.PATH)
     def get_path(self, uuid):
         """ Obtain the node path with a given uuid. """
         return self.service.getPath(token=self.token, uuid=uuid)
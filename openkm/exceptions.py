@@ -1,3 +1,10 @@
+# OpenKM faults raised when a token has expired or been logged out
+SESSION_EXPIRED_EXCEPTIONS = ('LoginException',)
+# AccessDeniedException is also raised for a real lack of permission, so it only means the
+# session has expired when its message is about the token
+SESSION_EXPIRED_MESSAGES = ('token', 'session')
+
+
 class ExceptionParser(object):
     """
         Utitility class to parse returned exceptions from SUDS
@@ -14,6 +21,34 @@ class ExceptionParser(object):
     def get_raised_exception_class(self, e):
         return e.fault.detail
 
+    def is_session_expired(self, e):
+        """ True if OpenKM rejected the call because the session token is no longer valid """
+        if self.is_fault(e, *SESSION_EXPIRED_EXCEPTIONS):
+            return True
+        if not self.is_fault(e, 'AccessDeniedException'):
+            return False
+        message = self.get_fault_message(e).lower()
+        return any(word in message for word in SESSION_EXPIRED_MESSAGES)
+
+    def get_fault_message(self, e):
+        try:
+            return unicode(self.get_message(e))
+        except (AttributeError, IndexError, TypeError, UnicodeError):
+            return unicode(getattr(getattr(e, 'fault', None), 'faultstring', '') or '')
+
+    def is_path_not_found(self, e):
+        return self.is_fault(e, 'PathNotFoundException')
+
+    def is_item_exists(self, e):
+        return self.is_fault(e, 'ItemExistsException')
+
+    def is_fault(self, e, *names):
+        """ True if e is a WebFault raised by one of the named OpenKM exceptions """
+        try:
+            return self.get_raised_exception_class_name(e) in names
+        except (AttributeError, IndexError, TypeError):
+            return False
+
 
 class ItemExistsException(Exception):
     pass
@@ -1,8 +1,14 @@
+import time
 import logging
+import threading
+from collections import deque, namedtuple
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 
-import client, utils
+from suds import WebFault
+
+import client, exceptions, utils
 
 
 class Session(object):
@@ -18,12 +24,19 @@ class Session(object):
         self.auth.logout()
 
 
+CategoryChanges = namedtuple('CategoryChanges', 'added removed timings')
+
+
 class Category(object):
 
-    def __init__(self):
-        self.folder = client.Folder()
-        self.repository = client.Repository()
-        self.property = client.Property()
+    folder = client.LazyService(client.Folder)
+    repository = client.LazyService(client.Repository)
+    property = client.LazyService(client.Property)
+    document = client.LazyService(client.Document)
+
+    # category writes for one node are spread over this many threads when there are more
+    WRITE_WORKERS = 4
+    write_pool = client.ServicePool(lambda: Category(), WRITE_WORKERS)
 
     def add_to_node(self, node_path, category_uuid):
         self.property.add_category(node_path, category_uuid)
@@ -61,12 +74,55 @@ class Category(object):
         """
         return "%s/%s" % (base_path, new_category_name)
 
+    def get_for_node(self, node_path):
+        """
+        :returns dict of uuid : path of the categories of the node, from its properties
+        """
+        # the categories are diffed against, so a stale cached copy won't do
+        properties = self.document.get_current_properties(node_path)
+        return dict((category.uuid, category.path) for category in getattr(properties, 'categories', None) or [])
+
+    def set_for_node(self, node_path, category_uuids, is_removable=None):
+        """
+        Makes the node's categories on OpenKM match category_uuids.  The current categories are
+        read once and only the missing categories are added, and the stale ones removed
+        :param category_uuids: iterable of category folder uuids
+        :param is_removable: function of (uuid, path) returning True if the category may be removed
+        from the node, which by default no category may be
+        :returns CategoryChanges of the sets of uuids added and removed, and a list of
+        (method name, uuid, seconds) for each call made
+        """
+        expected = set(category_uuids)
+        current = self.get_for_node(node_path)
+        added = expected - set(current)
+        removed = set(uuid for uuid, path in current.items()
+                      if uuid not in expected and is_removable is not None and is_removable(uuid, path))
+        writes = [('add_to_node', uuid) for uuid in added] + [('remove_from_node', uuid) for uuid in removed]
+        return CategoryChanges(added, removed, self.run_category_writes(node_path, writes))
+
+    def run_category_writes(self, node_path, writes):
+        """
+        :param writes: list of (Category method name, category uuid) tuples
+        :returns list of (method name, uuid, seconds)
+        """
+        if len(writes) <= self.WRITE_WORKERS:
+            return [self.timed_write(self, node_path, call) for call in writes]
+
+        return self.write_pool.map(lambda category, call: self.timed_write(category, node_path, call), writes)
+
+    def timed_write(self, category, node_path, call):
+        method_name, uuid = call
+        start = time.time()
+        getattr(category, method_name)(node_path, uuid)
+        elapsed = time.time() - start
+        logging.debug('%s %s %s took %.3fs', method_name, node_path, uuid, elapsed)
+        return method_name, uuid, elapsed
+
 
 class Keyword(object):
 
-    def __init__(self):
-        self.property = client.Property()
-        self.document = client.Document()
+    property = client.LazyService(client.Property)
+    document = client.LazyService(client.Document)
 
     def add(self, path, keyword):
         return self.property.add_keyword(path, keyword)
@@ -74,12 +130,13 @@ class Keyword(object):
     def remove(self, path, keyword):
         return self.property.remove_keyword(path, keyword)
 
-    def get_for_document(self, path):
+    def get_for_document(self, path, cached=True):
         """
         Returns a list of keywords
         :param path: OpenKM node path of document
+        :param cached: bool the metadata cache may be used, False when diffing against the keywords
         """
-        document = self.document.get_properties(path)
+        document = self.document.get_properties(path) if cached else self.document.get_current_properties(path)
         try:
             return document.keywords
         except AttributeError, e:
@@ -135,6 +192,44 @@ class FileSystem(object):
         return path
 
 
+class KnownFolderPaths(object):
+    """
+    Process wide record of the folder paths known to exist on OpenKM, so they needn't be checked
+    again, with a lock per path so concurrent callers creating the same folder take turns
+    """
+
+    def __init__(self):
+        self._paths = set()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, path):
+        return utils.remove_trailing_slash(path) in self._paths
+
+    def add(self, path):
+        path = utils.remove_trailing_slash(path)
+        with self._lock:
+            self._paths.add(path)
+
+    def discard(self, path):
+        """ Forgets path and everything below it """
+        path = utils.remove_trailing_slash(path)
+        with self._lock:
+            self._paths = set(known for known in self._paths if known != path and not known.startswith(path + '/'))
+
+    def clear(self):
+        with self._lock:
+            self._paths = set()
+
+    def lock(self, path):
+        path = utils.remove_trailing_slash(path)
+        with self._lock:
+            return self._locks.setdefault(path, threading.Lock())
+
+
+known_folder_paths = KnownFolderPaths()
+
+
 class FolderManager(client.Folder):
 
     def __init__(self):
@@ -143,16 +238,105 @@ class FolderManager(client.Folder):
     def create(self, folder_obj):
         folder_obj.path = utils.remove_trailing_slash(folder_obj.path)
         super(FolderManager, self).create(folder_obj)
+        known_folder_paths.add(folder_obj.path)
+
+    def delete(self, folder_path):
+        try:
+            return super(FolderManager, self).delete(folder_path)
+        finally:
+            known_folder_paths.discard(folder_path)
+
+
+RepositoryNode = namedtuple('RepositoryNode', 'kind node depth')
+
+
+class RepositoryCrawler(object):
+    """
+    Walks a folder tree breadth first, listing several folders at a time on a pool of threads,
+    and yields each document and folder found as a RepositoryNode.  Only the paths of folders
+    still to be listed are held in memory, so very large trees can be walked
+    """
+    DOCUMENT = 'document'
+    FOLDER = 'folder'
+
+    def __init__(self, workers=4, max_depth=None, path_filter=None, documents=True, folders=True):
+        """
+        :param workers: int number of folders listed at once
+        :param max_depth: int, eg. 1 only lists the starting folder.  None walks the whole tree
+        :param path_filter: callable taking a node path, returning False to skip the node.  A
+        skipped folder isn't descended into
+        :param documents: bool list documents.  Skipping them halves the calls per folder
+        :param folders: bool yield folders.  They are descended into either way
+        """
+        self.workers = workers
+        self.max_depth = max_depth
+        self.path_filter = path_filter
+        self.documents = documents
+        self.folders = folders
+        self.local = threading.local()
+
+    def crawl(self, path):
+        """
+        :param path: string the folder to start from
+        :returns generator of RepositoryNode
+        """
+        frontier = deque([(utils.remove_trailing_slash(path), 1)])
+        pool = ThreadPool(self.workers)
+        try:
+            while frontier:
+                # a few listings per thread keeps the pool busy without holding many results
+                batch = [frontier.popleft() for i in range(min(len(frontier), self.workers * 4))]
+                for (folder_path, depth), (documents, folders) in zip(batch, pool.imap(self.list_folder, batch)):
+                    for document in documents:
+                        if self.is_included(document.path):
+                            yield RepositoryNode(self.DOCUMENT, document, depth)
+                    for folder in folders:
+                        if not self.is_included(folder.path):
+                            continue
+                        if self.folders:
+                            yield RepositoryNode(self.FOLDER, folder, depth)
+                        if self.max_depth is None or depth < self.max_depth:
+                            frontier.append((folder.path, depth + 1))
+        finally:
+            pool.close()
+            pool.join()
+
+    def list_folder(self, item):
+        """
+        :param item: (folder path, depth)
+        :returns (list of documents, list of folders) in the folder
+        """
+        folder_path, depth = item
+        # suds clients aren't thread safe, so each pool thread has its own
+        if not hasattr(self.local, 'folder'):
+            self.local.document = client.Document()
+            self.local.folder = client.Folder()
+        try:
+            documents = self.get_items(self.local.document.get_children(folder_path)) if self.documents else []
+            return documents, self.get_items(self.local.folder.get_children(folder_path))
+        except Exception, e:
+            # carry on with the rest of the tree, as DirectoryListing always has
+            logging.exception(e)
+            return [], []
+
+    def get_items(self, result):
+        try:
+            return result[0] if isinstance(result[0], list) else []
+        except (AttributeError, IndexError, TypeError):
+            return []
+
+    def is_included(self, path):
+        return self.path_filter is None or self.path_filter(path)
 
 
 class DirectoryListing(object):
 
-    documents = []
-    folders = []
+    doc = client.LazyService(client.Document)
+    folder = client.LazyService(client.Folder)
 
     def __init__(self):
-        self.doc = client.Document()
-        self.folder = client.Folder()
+        self.documents = []
+        self.folders = []
 
     def get_root_path(self):
         return settings.OPENKM['configuration']['UploadRoot']
@@ -162,44 +346,16 @@ class DirectoryListing(object):
         Traverse files and folders
         Returns a list of document objects
         """
-
         if path is None:
             path = self.get_root_path()
-
-        # get files and add them to the file list
-        results = self.doc.get_children(path)
-
-        try:
-            for result in results[0]:
-                self.documents.append(result)
-        except:
-            pass
-
-        # get child folders of the path given as param
-        folders = self.folder.get_children(path)
-
-        # if there are child folders, traverse them recursively
-        try:
-            if isinstance(folders[0], list) and len(folders[0]) > 0:
-                for folder in folders[0]:
-                    self.traverse(path=folder.path)
-        except:
-            pass
-
+        self.documents = [result.node for result in SearchManager().list_subtree(path, folders=False)]
         return self.documents
 
     def traverse_folders(self, path):
-        print path
-        folders_temp = self.folder.get_children(path)
-
-        # if there are child folders, traverse them recursively
-        try:
-            if isinstance(folders_temp[0], list) and len(folders_temp[0]) > 0:
-                for folder in folders_temp[0]:
-                    self.folders.append(folder)
-                    self.traverse_folders(path=folder.path)
-        except Exception, e:
-            logging.exception(e)
+        """
+        Returns a list of all the folders below path
+        """
+        self.folders = [result.node for result in SearchManager().list_subtree(path, documents=False)]
         return self.folders
 
     def get_all_documents_in_folder(self, folder_path=settings.OPENKM['configuration']['UploadRoot']):
@@ -208,8 +364,7 @@ class DirectoryListing(object):
 
 class DocumentManager(object):
 
-    def __init__(self):
-        self.document = client.Document()
+    document = client.LazyService(client.Document)
 
     def create(self, file_obj, taxonomy=[]):
         document = self.document.new()
@@ -250,7 +405,7 @@ class DocumentManager(object):
         return "%s%s" % (settings.OPENKM['configuration']['UploadRoot'], filename)
 
     def convert_file_content_to_binary_for_transport(self, file_obj):
-        return utils.make_file_java_byte_array_compatible(file_obj)
+        return self.document.stream_content(file_obj)
 
     def create_document_on_openkm(self, document, content):
         okm_document = self.document.create(document, content)
@@ -271,8 +426,7 @@ class RepositoryManager(client.Repository):
 
 class Property(object):
 
-    def __init__(self):
-        self.property_group = client.PropertyGroup()
+    property_group = client.LazyService(client.PropertyGroup)
 
     def get_property_groups_for_document(self, doc_path):
         return self.property_group.get_groups(doc_path)
@@ -304,25 +458,21 @@ class Property(object):
 
         return properties
 
-    def get_language_label(self, language_code):
-        map = (
-            ('en', 'English'),
-            ('de', 'German'),
-            ('es', 'Spanish (Spain)*'),
-            ('fr', 'French'),
-            ('pt', 'Portuguese'),
-            ('zh', 'Chinese'),
-            ('ko', 'Korean'),
-            ('ja', 'Japanese'),
-            ('ru', 'Russian'),
-            ('ro', 'Romanian'),
-            )
-        map = dict(map)
+    LANGUAGE_LABELS = utils.ChoiceIndex((
+        ('en', 'English'),
+        ('de', 'German'),
+        ('es', 'Spanish (Spain)*'),
+        ('fr', 'French'),
+        ('pt', 'Portuguese'),
+        ('zh', 'Chinese'),
+        ('ko', 'Korean'),
+        ('ja', 'Japanese'),
+        ('ru', 'Russian'),
+        ('ro', 'Romanian'),
+    ))
 
-        try:
-            return map[language_code]
-        except:
-            return 'English'
+    def get_language_label(self, language_code):
+        return self.LANGUAGE_LABELS.get_label(language_code, 'English')
 
     def update_options_list(self, options, new_value):
        for option in options:
@@ -339,11 +489,114 @@ class Property(object):
         self.property_group.remove_group(node_path, group_name)
         return self.property_group.set_properties(node_path, group_name, properties)
 
+    # property groups of one document are read or written on this many threads at once
+    GROUP_WORKERS = 4
+    group_pool = client.ServicePool(client.PropertyGroup, GROUP_WORKERS)
+
+    def get_group_names(self, doc_path):
+        """ :returns set of the names of the property groups the document has """
+        groups = self.get_property_groups_for_document(doc_path)
+        if not groups:
+            return set()
+        return set(group.name for group in groups[0] if hasattr(group, 'name'))
+
+    def get_groups_properties(self, doc_path, group_names):
+        """
+        Reads several of a document's property groups at once
+        :param group_names: iterable of property group names
+        :returns dict of group name : formElementComplexArray
+        """
+        group_names = list(group_names)
+        results = self.run_group_calls([('get_properties', doc_path, group_name) for group_name in group_names])
+        return dict(zip(group_names, results))
+
+    def set_groups_properties(self, doc_path, groups):
+        """
+        Writes several of a document's property groups at once.  setProperties replaces the
+        values of the properties it is given, so the groups aren't removed first
+        :param groups: dict of group name : formElementComplexArray
+        """
+        self.run_group_calls([('set_properties', doc_path, group_name, properties) for group_name, properties in groups.items()])
+
+    def run_group_calls(self, calls):
+        """
+        :param calls: list of (client.PropertyGroup method name, arguments...) tuples
+        :returns list of the results, in the order of calls
+        """
+        if len(calls) <= 1:
+            return [getattr(self.property_group, call[0])(*call[1:]) for call in calls]
+
+        return self.group_pool.map(lambda property_group, call: getattr(property_group, call[0])(*call[1:]), calls)
+
 
 class SearchManager(client.Search):
+    # JCR node types of the nodes listed by list_subtree
+    NODE_TYPES = {
+        RepositoryCrawler.DOCUMENT: 'okm:document',
+        RepositoryCrawler.FOLDER: 'okm:folder',
+    }
+
     def __init__(self):
         super(SearchManager, self).__init__(class_name='Search')
 
+    def list_subtree(self, path, documents=True, folders=True):
+        """
+        Lists everything below a folder with XPath statements instead of a getChilds call per
+        folder.  The subtree is fetched a page at a time, one page per child folder of path, so
+        no single reply holds all of it.  A page whose statement fails is crawled instead
+        :param path: string folder path
+        :param documents: bool list documents
+        :param folders: bool list folders
+        :returns generator of RepositoryNode, with depth relative to path
+        """
+        path = utils.remove_trailing_slash(path)
+        kinds = [kind for kind, wanted in ((RepositoryCrawler.DOCUMENT, documents), (RepositoryCrawler.FOLDER, folders)) if wanted]
+        root_depth = path.count('/')
+
+        try:
+            children = self.query_nodes(path, [RepositoryCrawler.FOLDER], root_depth, descendants=False)
+            page = self.query_nodes(path, [kind for kind in kinds if kind != RepositoryCrawler.FOLDER], root_depth, descendants=False)
+        except WebFault, e:
+            logging.exception(e)
+            for node in self.crawl(path, documents, folders, root_depth):
+                yield node
+            return
+
+        for node in page:
+            yield node
+        for child in children:
+            if folders:
+                yield child
+            try:
+                page = self.query_nodes(child.node.path, kinds, root_depth)
+            except WebFault, e:
+                logging.exception(e)
+                page = self.crawl(child.node.path, documents, folders, root_depth)
+            for node in page:
+                yield node
+
+    def query_nodes(self, path, kinds, root_depth, descendants=True):
+        """
+        :param kinds: list of RepositoryCrawler.DOCUMENT and RepositoryCrawler.FOLDER
+        :param descendants: bool everything below path, rather than just its children
+        :returns list of RepositoryNode
+        """
+        nodes = []
+        for kind in kinds:
+            statement = '/jcr:root%s%selement(*, %s)' % (
+                utils.iso9075_encode_path(path), '//' if descendants else '/', self.NODE_TYPES[kind])
+            result = self.by_statement(statement, 'xpath')
+            for item in getattr(result, 'item', None) or []:
+                node = getattr(item, kind, None)
+                if node is not None:
+                    nodes.append(RepositoryNode(kind, node, node.path.count('/') - root_depth))
+        return nodes
+
+    def crawl(self, path, documents, folders, root_depth):
+        crawler = RepositoryCrawler(documents=documents, folders=folders)
+        for node in crawler.crawl(path):
+            yield node._replace(depth=node.node.path.count('/') - root_depth)
+
 
 class Taxonomy(object):
     """
@@ -352,11 +605,13 @@ class Taxonomy(object):
         /okm:root/Uploads/[region]/[year]/Team/
 
     """
+    repository = client.LazyService(RepositoryManager)
+    folder = client.LazyService(FolderManager)
+    known_paths = known_folder_paths
+
     def __init__(self, folders=[]):
         # Remove the leading forward slash if present
         self.root_path = utils.remove_trailing_slash(settings.OPENKM['configuration']['UploadRoot'])
-        self.repository = RepositoryManager()
-        self.folder = FolderManager()
         if folders:
             dependencies = self.generate_path_dependencies(folders)
             self.build_path(dependencies)
@@ -408,22 +663,60 @@ class Taxonomy(object):
 
     def build_path(self, dependencies):
         """
-        :param dependencies: list. a list of folder paths which must exist.  If the folders do not
-        exist, they will be created
+        :param dependencies: list. a list of folder paths which must exist, deepest first, as returned by
+        generate_path_dependencies().  If the folders do not exist, they will be created
         :returns boolean: True when path has been created
         """
-        import ipdb; ipdb.set_trace()
-        if self.repository.has_node(dependencies[0]):
-            return True
-
-        folders_to_create = [dependency for dependency in dependencies if not self.repository.has_node(dependency)]
-        folders_to_create.reverse()
+        paths = [utils.remove_trailing_slash(dependency) for dependency in dependencies]
+
+        # each attempt after the first forgets one more folder wrongly remembered as existing
+        for attempt in range(len(paths)):
+            missing = self.get_missing_paths(paths)
+            # create the missing folders, parents first
+            for path in reversed(missing):
+                try:
+                    self.create_folder(path)
+                except WebFault, e:
+                    if not exceptions.ExceptionParser().is_path_not_found(e) or attempt == len(paths) - 1:
+                        raise
+                    # the parent was deleted outside this process since it was remembered, so
+                    # forget it and walk up again
+                    self.known_paths.discard(path.rsplit('/', 1)[0])
+                    break
+            else:
+                return True
 
-        for path in folders_to_create:
+    def get_missing_paths(self, paths):
+        """
+        Walks up from the deepest folder until one is found which exists
+        :param paths: list of folder paths, deepest first
+        :returns list of the paths which don't exist, deepest first
+        """
+        missing = []
+        for path in paths:
+            if path in self.known_paths:
+                break
+            if self.repository.has_node(path):
+                self.known_paths.add(path)
+                break
+            missing.append(path)
+        return missing
+
+    def create_folder(self, path):
+        with self.known_paths.lock(path):
+            if path in self.known_paths:
+                # created by another thread while this one waited
+                return
             okm_folder = self.folder.new()
             okm_folder.path = path
-            self.folder.create(okm_folder)
-            logging.info('Created folder path: %s', path)
+            try:
+                self.folder.create(okm_folder)
+                logging.info('Created folder path: %s', path)
+            except WebFault, e:
+                # created by another process
+                if not exceptions.ExceptionParser().is_item_exists(e):
+                    raise
+            self.known_paths.add(path)
 
     # def build_path(self, root_path, dependencies):
     #     """
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from openkm import models, outbound
+
+
+class Command(BaseCommand):
+    help = 'Runs the queued syncs of documents to OpenKM'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help="Number of threads, defaults to OPENKM['configuration']['SyncWorkers']"),
+        make_option('--once', action='store_true', dest='once', default=False,
+                    help='Exit once there are no more jobs due, instead of waiting for more'),
+    )
+
+    def handle(self, *args, **options):
+        worker = outbound.SyncWorker(workers=options['workers'])
+        try:
+            worker.run(once=options['once'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('%s jobs pending\n' % models.OpenKmSyncJob.objects.pending_count())
@@ -1,10 +1,12 @@
+import time
 import datetime
 import operator
 import logging
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
-from django.db.models import Q
+from django.db.models import F, Q
+from django.contrib.contenttypes.models import ContentType
 
 import facades
 
@@ -45,59 +47,136 @@ class OpenKmFolderListManager(models.Manager):
 
     def get_custom_queryset(self, and_predicates, or_predicates):
         """
+        Finds the folders named in or_predicates which are filed under the category named in
+        and_predicates, using the indexed okm_category and okm_name columns rather than
+        scanning okm_path
         :param and_predicates: list of AND query arguments eg. ['category', 'Region']
         :param or_predicates: list of OR query arguments eg. ['Latin-America', 'EMEA']
         :returns queryset
         """
-        if and_predicates:
-            and_predicates_list = self._build_and_predicate_list(and_predicates)
-            and_list = [Q(x) for x in and_predicates_list]
-            and_list = reduce(operator.and_, and_list)
-        else:
+        if not and_predicates or not or_predicates:
             return []
 
-        if or_predicates:
-            or_predicates_list = self._build_or_predicate_list(or_predicates)
-            or_list = [Q(x) for x in or_predicates_list]
-            or_list = reduce(operator.or_, or_list)
+        ancestors = [self._normalise(argument) for argument in and_predicates if 'categories' not in argument]
+        names = [self._normalise(argument) for argument in or_predicates]
+
+        query_set = super(OpenKmFolderListManager, self).get_query_set().filter(okm_name__in=names)
+        if ancestors:
+            query_set = query_set.filter(okm_category=ancestors[0])
         else:
+            query_set = query_set.filter(okm_category__isnull=False)
+        for ancestor in ancestors[1:]:
+            # deeper ancestors aren't indexed, but the indexed filters have already narrowed the rows
+            query_set = query_set.filter(okm_path__icontains='/%s/' % ancestor)
+        return query_set
+
+    def get_category_folders(self, and_predicates, or_predicates):
+        """
+        Resolves the same predicates as get_custom_queryset from the in-memory category trie
+        :returns list of (uuid, path) tuples
+        """
+        if not and_predicates or not or_predicates:
             return []
+        ancestors = [self._normalise(argument) for argument in and_predicates if 'categories' not in argument]
+        names = [self._normalise(argument) for argument in or_predicates]
+        return self.get_category_trie().resolve(ancestors, names)
 
-        query_set = super(OpenKmFolderListManager, self).get_query_set()
+    def get_category_trie(self):
+        """
+        The folder list loaded into a CategoryTrie.  It is rebuilt once it is older than the
+        CategoryTrieTimeout setting, or when refresh_category_trie() is called
+        """
+        timeout = settings.OPENKM['configuration'].get('CategoryTrieTimeout', 300)
+        trie = getattr(self, '_category_trie', None)
+        if trie is None or trie.loaded + timeout < time.time():
+            trie = self.refresh_category_trie()
+        return trie
 
-        try:
-            if or_list:
-                query_set = query_set.filter(or_list)
-            if and_list:
-                query_set = query_set.filter(and_list)
+    def refresh_category_trie(self):
+        trie = CategoryTrie(super(OpenKmFolderListManager, self).get_query_set().values_list('okm_uuid', 'okm_path'))
+        self._category_trie = trie
+        return trie
 
-            return query_set
-        except TypeError, e:
-            logging.exception(e)
-        except AttributeError, e:
-            logging.exception(e)
+    def _normalise(self, argument):
+        """ Converts a Django value to the lower case OpenKM folder name stored in the index """
+        return facades.FileSystem().normalise_string_for_openkm(argument).lower()
 
-    def _build_and_predicate_list(self, arguments):
-        args = []
-        for argument in arguments:
-            if 'categories' in argument:
-                args.append(('okm_path__icontains', '/okm:%s/' % argument))
-            else:
-                args.append(('okm_path__icontains', '/%s/' % argument))
-        return args
 
-    def _build_or_predicate_list(self, arguments):
-        return [('okm_path__icontains', '/%s' % argument) for argument in arguments]
+class CategoryTrie(object):
+    """
+    The folder list held in memory as a trie of lower case category name, then folder name,
+    so category predicates resolve without a query.  Built from (uuid, path) pairs
+    """
+
+    def __init__(self, folders):
+        self.categories = {}
+        self.paths = {}
+        for uuid, path in folders:
+            self.add(uuid, path)
+        self.loaded = time.time()
+
+    def add(self, uuid, path):
+        self.paths[path] = uuid
+        index = get_path_index(path)
+        if index['okm_category'] is None:
+            return
+        names = self.categories.setdefault(index['okm_category'], {})
+        names.setdefault(index['okm_name'], []).append((uuid, path))
+
+    def resolve(self, ancestors, names):
+        """
+        :param ancestors: list of lower case folder names, the first being the category
+        :param names: list of lower case folder names
+        :returns list of (uuid, path) tuples of the matching folders
+        """
+        if ancestors:
+            categories = [self.categories.get(ancestors[0], {})]
+        else:
+            categories = self.categories.values()
+        folders = []
+        for category in categories:
+            for name in names:
+                for uuid, path in category.get(name, []):
+                    lower_path = path.lower()
+                    if all('/%s/' % ancestor in lower_path for ancestor in ancestors[1:]):
+                        folders.append((uuid, path))
+        return folders
+
+    def get_uuid(self, path):
+        return self.paths.get(path)
+
+
+def get_path_index(path):
+    """
+    Splits an OpenKM folder path into the values indexed by OpenKmFolderList
+    :param path: string eg. '/okm:categories/Region/EMEA'
+    :returns dict of okm_category, the lower case name of the category the folder is filed
+    under, and okm_name, the lower case folder name.  okm_category is None for the category
+    folders themselves and for folders outside the categories tree
+    """
+    if not path:
+        return {'okm_category': None, 'okm_name': None}
+    segments = path.lower().strip('/').split('/')
+    category = segments[1] if len(segments) > 2 and segments[0] == 'okm:categories' else None
+    return {'okm_category': category, 'okm_name': segments[-1]}
 
 
 class OpenKmFolderList(OpenKmMetadata):
     okm_has_childs = models.CharField(max_length=255, blank=True, null=True)
+    # lower case path segments, derived from okm_path by get_path_index, for indexed lookups
+    okm_category = models.CharField(max_length=255, blank=True, null=True, db_index=True)
+    okm_name = models.CharField(max_length=255, blank=True, null=True, db_index=True)
 
     objects = OpenKmFolderListManager()
 
     def __unicode__(self):
         return "%s" % self.okm_path
 
+    def save(self, *args, **kwargs):
+        for field, value in get_path_index(self.okm_path).items():
+            setattr(self, field, value)
+        super(OpenKmFolderList, self).save(*args, **kwargs)
+
     class Meta:
         abstract = True
         verbose_name = 'OpenKM Folder List'
@@ -108,6 +187,9 @@ class OpenKmDocument(OpenKmMetadata):
 
     okm_filename = models.CharField(max_length=255, blank=True, null=True)
     file = models.FileField(max_length=255, upload_to='resources/%Y/%m/%d/', blank=True, null=True, help_text="Upload a file from your local machine")
+    # hashes of what was last synced, see sync.DocumentFingerprint, and when
+    okm_fingerprint = models.CharField(max_length=255, blank=True, null=True, editable=False)
+    okm_synced = models.DateTimeField(blank=True, null=True, editable=False)
 
     def upload_to_openkm(self, file_obj, taxonomy=[]):
         """Uploads the document to the OpenKM server """
@@ -150,8 +232,144 @@ class OpenKmDocument(OpenKmMetadata):
         return date.strftime('%Y-%m-%dT00:00:00.356+01:00')
 
 
+class OpenKmSyncJobManager(models.Manager):
+
+    def enqueue(self, document, action):
+        """
+        Queues a sync of the document.  A document has at most one pending job, so changes made
+        before the job runs are coalesced into it
+        :param document: OpenKmDocument subclass instance
+        :param action: OpenKmSyncJob.SYNC or OpenKmSyncJob.DELETE
+        """
+        content_type = ContentType.objects.get_for_model(document)
+        pending_key = OpenKmSyncJob.get_pending_key(content_type, document.pk)
+        now = datetime.datetime.now()
+        if self.coalesce(pending_key, action, document.okm_path, now):
+            return
+
+        # pending_key is unique, so of two saves racing to queue the document only one creates the job
+        sid = transaction.savepoint()
+        try:
+            self.create(content_type=content_type, object_id=document.pk, action=action, pending_key=pending_key,
+                        okm_path=document.okm_path, available_at=now)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            self.coalesce(pending_key, action, document.okm_path, now)
+        else:
+            transaction.savepoint_commit(sid)
+
+    def coalesce(self, pending_key, action, okm_path, now):
+        """ :returns True if there was a pending job for the document to update """
+        # a new sequence tells a worker running the job that it needs to run again
+        return self.filter(pending_key=pending_key).update(
+            action=action, okm_path=okm_path, sequence=F('sequence') + 1, attempts=0, available_at=now)
+
+    def lease(self, worker, count, duration):
+        """
+        Claims up to count jobs which are due for worker, for duration seconds.  A job whose lease
+        expires, eg. because its worker died, can be claimed again
+        :returns list of OpenKmSyncJob
+        """
+        now = datetime.datetime.now()
+        available = Q(leased_until__isnull=True) | Q(leased_until__lt=now)
+        due = self.filter(available, status=OpenKmSyncJob.PENDING, available_at__lte=now)
+        pks = list(due.order_by('available_at').values_list('pk', flat=True)[:count])
+        if not pks:
+            return []
+        leased_until = now + datetime.timedelta(seconds=duration)
+        # only jobs which are still available are claimed, so two workers never hold the same job
+        self.filter(available, pk__in=pks).update(leased_by=worker, leased_until=leased_until)
+        return list(self.filter(pk__in=pks, leased_by=worker, leased_until=leased_until))
+
+    def renew(self, jobs, worker, duration):
+        """
+        Extends the leases worker still holds on jobs, so a long running job isn't claimed by another worker
+        :returns int number of leases renewed
+        """
+        leased_until = datetime.datetime.now() + datetime.timedelta(seconds=duration)
+        return self.filter(pk__in=[job.pk for job in jobs], leased_by=worker).update(leased_until=leased_until)
 
+    def complete(self, job):
+        """ Removes a finished job, unless the document changed again while it was running """
+        if self.filter(pk=job.pk, sequence=job.sequence).update(status=OpenKmSyncJob.DONE, pending_key=None):
+            self.filter(pk=job.pk).delete()
+        else:
+            self.release(job)
 
+    def release(self, job):
+        # the lease may have been lost to another worker, whose lease is left alone
+        self.filter(pk=job.pk, leased_by=job.leased_by).update(leased_by=None, leased_until=None)
 
+    def fail(self, job, error, max_attempts, backoff):
+        """
+        Schedules a retry of a failed job after backoff * 2 ** attempts seconds, or marks it
+        dead once it has been tried max_attempts times
+        """
+        attempts = job.attempts + 1
+        values = {'attempts': attempts, 'last_error': unicode(error), 'leased_by': None, 'leased_until': None}
+        if attempts >= max_attempts:
+            values.update(status=OpenKmSyncJob.DEAD, pending_key=None)
+        else:
+            values['available_at'] = datetime.datetime.now() + datetime.timedelta(seconds=backoff * 2 ** job.attempts)
+        if not self.filter(pk=job.pk, sequence=job.sequence).update(**values):
+            # the document changed again, so the new job gets a fresh set of attempts
+            self.release(job)
+
+    def pending_count(self):
+        return self.filter(status=OpenKmSyncJob.PENDING).count()
+
+
+class OpenKmSyncJob(models.Model):
+    """
+    A queued outbound sync of one document, added by the OpenKmDocument signals in outbound
+    and run by the openkm_sync_worker management command
+    """
+    SYNC = 'sync'
+    DELETE = 'delete'
+    ACTION_CHOICES = ((SYNC, 'Sync'), (DELETE, 'Delete'))
+
+    PENDING = 'pending'
+    DONE = 'done'
+    DEAD = 'dead'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (DONE, 'Done'), (DEAD, 'Dead'))
+
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES, default=SYNC)
+    # kept so the document can be deleted from OpenKM after it has gone from the database
+    okm_path = models.CharField(max_length=1000, blank=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    # set only while the job is pending, so a document never has two pending jobs
+    pending_key = models.CharField(max_length=255, unique=True, blank=True, null=True, editable=False)
+    sequence = models.PositiveIntegerField(default=0)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    available_at = models.DateTimeField(db_index=True)
+    leased_by = models.CharField(max_length=255, blank=True, null=True)
+    leased_until = models.DateTimeField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    objects = OpenKmSyncJobManager()
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.action, self.content_type, self.object_id)
+
+    @staticmethod
+    def get_pending_key(content_type, object_id):
+        return '%s:%s' % (content_type.pk, object_id)
+
+    def get_document(self):
+        """ :returns the document, or None if it has been deleted """
+        model_class = self.content_type.model_class()
+        try:
+            return model_class._default_manager.get(pk=self.object_id)
+        except model_class.DoesNotExist:
+            return None
+
+    class Meta:
+        verbose_name = 'OpenKM Sync Job'
+        verbose_name_plural = 'OpenKM Sync Jobs'
 
 
+# connects the signals which queue OpenKmSyncJobs
+import outbound
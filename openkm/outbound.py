@@ -0,0 +1,231 @@
+"""
+Queues outbound syncs of OpenKmDocuments as they change, and runs the queued syncs
+"""
+import os
+import Queue
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db.models import get_model, signals
+
+from suds import WebFault
+
+import client, exceptions, models, sync
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+
+@contextmanager
+def suppressed():
+    """ Changes made to documents in the block, eg. by a sync itself, aren't queued """
+    _state.suppressed = getattr(_state, 'suppressed', 0) + 1
+    try:
+        yield
+    finally:
+        _state.suppressed -= 1
+
+
+def is_enabled():
+    return settings.OPENKM['configuration'].get('SyncQueue', False) and not getattr(_state, 'suppressed', 0)
+
+
+def document_saved(sender, instance, raw=False, **kwargs):
+    if raw or not isinstance(instance, models.OpenKmDocument) or not is_enabled():
+        return
+    models.OpenKmSyncJob.objects.enqueue(instance, models.OpenKmSyncJob.SYNC)
+
+
+def document_deleted(sender, instance, **kwargs):
+    if not isinstance(instance, models.OpenKmDocument) or not is_enabled():
+        return
+    if instance.okm_path:
+        models.OpenKmSyncJob.objects.enqueue(instance, models.OpenKmSyncJob.DELETE)
+
+
+def categories_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if action not in ('pre_clear', 'post_add', 'post_remove', 'post_clear') or not is_enabled():
+        return
+    if isinstance(instance, models.OpenKmDocument):
+        if action != 'pre_clear':
+            models.OpenKmSyncJob.objects.enqueue(instance, models.OpenKmSyncJob.SYNC)
+    elif reverse and issubclass(model, models.OpenKmDocument):
+        # changed from the category's side, eg. region.document_set.add(document)
+        key = (sender, instance.pk)
+        if action == 'pre_clear':
+            # post_clear has no pk_set, so the documents are found before they're removed
+            _state.cleared = getattr(_state, 'cleared', {})
+            _state.cleared[key] = get_related_document_pks(sender, instance, model)
+            return
+        if action == 'post_clear':
+            pk_set = getattr(_state, 'cleared', {}).pop(key, None)
+        if pk_set:
+            for document in model._default_manager.filter(pk__in=pk_set):
+                models.OpenKmSyncJob.objects.enqueue(document, models.OpenKmSyncJob.SYNC)
+
+
+def get_related_document_pks(through, instance, model):
+    """ :returns list of the pks of the documents related to instance through the many-to-many table """
+    for field in model._meta.many_to_many:
+        if field.rel.through is through:
+            return list(model._default_manager.filter(**{field.name: instance}).values_list('pk', flat=True))
+    return []
+
+
+signals.post_save.connect(document_saved, dispatch_uid='openkm.outbound.document_saved')
+signals.post_delete.connect(document_deleted, dispatch_uid='openkm.outbound.document_deleted')
+signals.m2m_changed.connect(categories_changed, dispatch_uid='openkm.outbound.categories_changed')
+
+
+def get_folderlist_class():
+    """ The OpenKmFolderList subclass named by the FolderListModel setting, eg. 'documents.FolderList' """
+    name = settings.OPENKM['configuration'].get('FolderListModel')
+    if not name:
+        raise ImproperlyConfigured("OPENKM['configuration']['FolderListModel'] is required by the sync queue")
+    if not isinstance(name, basestring):
+        return name
+    return get_model(*name.split('.'))
+
+
+class SyncWorker(object):
+    """
+    Runs queued OpenKmSyncJobs on a pool of threads.  Jobs are leased from the database only as
+    threads become free, so when OpenKM is slow the backlog waits in the queue table rather
+    than in memory.  A failed job is retried with exponential backoff and marked dead after
+    max_attempts, to be inspected in the admin
+    """
+
+    def __init__(self, workers=None, lease=None, max_attempts=None, backoff=None, poll_interval=None):
+        """
+        :param workers: int number of threads, defaults to the SyncWorkers setting
+        :param lease: seconds a job is held before another worker may take it, defaults to SyncQueueLease
+        :param max_attempts: int, defaults to SyncQueueMaxAttempts
+        :param backoff: seconds before the first retry, doubled for each one after, defaults to SyncRetryBackoff
+        :param poll_interval: seconds to wait when no jobs are due, defaults to SyncQueuePollInterval
+        """
+        configuration = settings.OPENKM['configuration']
+        self.workers = workers or configuration.get('SyncWorkers', 4)
+        self.lease = lease or configuration.get('SyncQueueLease', 300)
+        self.max_attempts = max_attempts or configuration.get('SyncQueueMaxAttempts', 5)
+        self.backoff = backoff if backoff is not None else configuration.get('SyncRetryBackoff', 1)
+        self.poll_interval = poll_interval or configuration.get('SyncQueuePollInterval', 5)
+        self.name = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.folderlist_class = get_folderlist_class()
+        self.jobs = Queue.Queue(maxsize=self.workers)
+        self.local = threading.local()
+        self.stopping = threading.Event()
+        # jobs being run, whose leases are renewed until they finish
+        self.running = set()
+        self.running_lock = threading.Lock()
+
+    def run(self, once=False):
+        """
+        :param once: bool stop once there are no more jobs due, instead of waiting for more
+        """
+        finished = threading.Event()
+        threads = [threading.Thread(target=self.work) for i in range(self.workers)]
+        threads.append(threading.Thread(target=self.renew_leases, args=(finished,)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while not self.stopping.is_set():
+                free = self.jobs.maxsize - self.jobs.qsize()
+                jobs = models.OpenKmSyncJob.objects.lease(self.name, free, self.lease) if free else []
+                for job in jobs:
+                    self.jobs.put(job)
+                if not jobs:
+                    if once and free:
+                        break
+                    self.stopping.wait(self.poll_interval)
+        finally:
+            for thread in threads[:-1]:
+                self.jobs.put(None)
+            finished.set()
+            for thread in threads:
+                thread.join()
+            connection.close()
+
+    def stop(self):
+        self.stopping.set()
+
+    def work(self):
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                self.run_job(job)
+        finally:
+            # Django opens a database connection per thread
+            connection.close()
+
+    def renew_leases(self, finished):
+        """ Renews the leases of the running jobs a few times per lease, until finished is set """
+        try:
+            while not finished.wait(self.lease / 3.0):
+                with self.running_lock:
+                    jobs = list(self.running)
+                if not jobs:
+                    continue
+                try:
+                    models.OpenKmSyncJob.objects.renew(jobs, self.name, self.lease)
+                except Exception, e:
+                    logger.exception(e)
+        finally:
+            connection.close()
+
+    def run_job(self, job):
+        with self.running_lock:
+            self.running.add(job)
+        try:
+            self.run_leased_job(job)
+        finally:
+            with self.running_lock:
+                self.running.discard(job)
+
+    def run_leased_job(self, job):
+        try:
+            with suppressed():
+                if job.action == models.OpenKmSyncJob.DELETE:
+                    self.delete(job)
+                else:
+                    self.sync(job)
+        except Exception, e:
+            logger.exception(e)
+            models.OpenKmSyncJob.objects.fail(job, e, self.max_attempts, self.backoff)
+        else:
+            models.OpenKmSyncJob.objects.complete(job)
+
+    def sync(self, job):
+        document = job.get_document()
+        if document is None:
+            # deleted since the job was queued, its delete job has replaced this one
+            return
+        self.get_syncer().sync(document, self.folderlist_class)
+
+    def delete(self, job):
+        try:
+            self.get_document_client().delete(job.okm_path)
+        except WebFault, e:
+            # already gone from OpenKM
+            if not exceptions.ExceptionParser().is_path_not_found(e):
+                raise
+
+    def get_syncer(self):
+        # suds clients aren't thread safe, so each thread has its own
+        if not hasattr(self.local, 'syncer'):
+            self.local.syncer = sync.DjangoToOpenKm()
+        return self.local.syncer
+
+    def get_document_client(self):
+        if not hasattr(self.local, 'document'):
+            self.local.document = client.Document()
+        return self.local.document
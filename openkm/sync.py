@@ -1,18 +1,34 @@
+import re
+import json
+import time
+import hashlib
+import datetime
+import Queue
+import copy
+import socket
+import urllib2
 import logging
+import operator
+import itertools
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 logger = logging.getLogger( __name__ )
 
 from django.conf import settings
-from django.db import transaction
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
 
 from suds import WebFault
+from suds.transport import TransportError
 
-import client, facades, utils, sync
+import client, facades, models, outbound, utils, sync
 
 
 class SyncKeywords(object):
 
-    def __init__(self):
-        self.keyword = facades.Keyword()
+    keyword = client.LazyService(facades.Keyword)
 
     def get_tags_from_document(self, document):
         """
@@ -20,16 +36,38 @@ class SyncKeywords(object):
         """
         return document.tags.split(',')
 
+    # keyword writes for one document are spread over this many threads when there are more
+    WRITE_WORKERS = 4
+    write_pool = client.ServicePool(facades.Keyword, WRITE_WORKERS)
+
     def add_keyword_to_openkm_document(self, path, keyword):
         return self.keyword.add(path, keyword.strip())
 
     def write_keywords_to_openkm_document(self, path, keywords):
         """
+        Makes the document's keywords on OpenKM match keywords.  The current keywords are read
+        once and only the keywords missing from OpenKM are added, and the stale ones removed
         :param path: string  The document path on OpenKM
         :param keywords: list The keywords to be associated with a document
+        :returns (set of keywords added, set of keywords removed)
+        """
+        expected = set(keyword.strip() for keyword in keywords if keyword and keyword.strip())
+        current = set(utils.remove_none_elements_from_list(self.keyword.get_for_document(path, cached=False) or []))
+        added, removed = expected - current, current - expected
+        writes = [('add', keyword) for keyword in added] + [('remove', keyword) for keyword in removed]
+        self.run_keyword_writes(path, writes)
+        return added, removed
+
+    def run_keyword_writes(self, path, writes):
+        """
+        :param writes: list of (facades.Keyword method name, keyword) tuples
         """
-        for keyword in keywords:
-            self.add_keyword_to_openkm_document(path, keyword)
+        if len(writes) <= self.WRITE_WORKERS:
+            for method_name, keyword in writes:
+                getattr(self.keyword, method_name)(path, keyword)
+            return
+
+        self.write_pool.map(lambda keyword, call: getattr(keyword, call[0])(path, call[1]), writes)
 
     def confirm_keywords_written_to_openkm(self, path, expected_keywords):
         """
@@ -37,13 +75,9 @@ class SyncKeywords(object):
         :param path: OpenKM node path of document
         :param expected_keywords: list
         """
-        openkm_keywords = self.keyword.get_for_document(path)
-        diff = set(expected_keywords).difference(set(openkm_keywords))
-
-        if diff == 0:
-            return True
-        else:
-            return False
+        openkm_keywords = self.keyword.get_for_document(path) or []
+        diff = set(keyword.strip() for keyword in expected_keywords).difference(set(openkm_keywords))
+        return not diff
 
     def single_document_django_to_helix(self, document, openkm_document):
         """
@@ -63,7 +97,8 @@ class SyncKeywords(object):
         """
         keywords = self.keyword.get_for_document(openkm_document.path)
         tags = ','.join(keywords)
-        document.update_tags(tags)
+        with outbound.suppressed():
+            document.update_tags(tags)
 
 
 class SyncCategories(object):
@@ -81,9 +116,10 @@ class SyncCategories(object):
         'Task': 'Tasks',
         'Product': 'Products'
     }
+    # OpenKM category name -> Django model name
+    map_index = utils.ChoiceIndex(map.items())
 
-    def __init__(self):
-        self.category = facades.Category()
+    category = client.LazyService(facades.Category)
 
     def create_top_level_categories(self, parent_path=False):
         """
@@ -143,6 +179,25 @@ class SyncCategories(object):
 
         return _set.all()
 
+    def get_related_objects(self, related_class, values):
+        """
+        Finds the objects named by the values in one query.  A value matches an object whose
+        name contains it, though an exact match is preferred
+        :returns dict of { value : object }
+        """
+        if not values:
+            return {}
+        candidates = list(related_class.objects.filter(reduce(operator.or_, [Q(name__contains=value) for value in values])))
+        objects = {}
+        for value in values:
+            matches = [candidate for candidate in candidates if candidate.name == value] or \
+                      [candidate for candidate in candidates if value in candidate.name]
+            if len(matches) == 1:
+                objects[value] = matches[0]
+            else:
+                logger.error('%s %s objects match %s', len(matches), related_class.__name__, value)
+        return objects
+
     def get_related_objects_from_model(self, document, related_model_name):
         """
         :param document: object instance of Document
@@ -162,28 +217,123 @@ class SyncCategories(object):
             logger.error("Object does not have method %s" % method_name)
 
 
+PropertySpec = namedtuple('PropertySpec', 'name meta')
+
+
+class PropertyGroupTemplates(object):
+    """
+    The property groups in settings.OPENKM['properties'] compiled into read only specs.  Filling
+    the templates for a document builds new dicts, or copies of groupProperties skeletons which
+    are built once, so the settings are never changed and documents may be synced concurrently
+    """
+    _compiled = None
+    _compile_lock = threading.Lock()
+
+    def __init__(self, groups):
+        """
+        :param groups: dict of the form of settings.OPENKM['properties']
+        """
+        self.source = groups
+        self.groups = tuple(
+            (group_name, tuple(PropertySpec(name, tuple(sorted(meta.items()))) for name, meta in sorted(properties.items())))
+            for group_name, properties in sorted(groups.items()))
+        self._skeletons = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        """ The templates for the current settings, compiled again only if the setting is replaced """
+        with cls._compile_lock:
+            if cls._compiled is None or cls._compiled.source is not settings.OPENKM['properties']:
+                cls._compiled = cls(settings.OPENKM['properties'])
+            return cls._compiled
+
+    def fill_values(self, values):
+        """
+        :param values: dict of property name : value
+        :returns dict of the form { group name : { property name : [value], ... } } of the
+        configured properties which have a value
+        """
+        return dict((group_name, dict((spec.name, [values[spec.name]]) for spec in specs if spec.name in values))
+                    for group_name, specs in self.groups)
+
+    def fill_map(self, values):
+        """
+        :param values: dict of property name : value
+        :returns a copy of the settings with the value added to the settings of each property, as
+        used by facades.Property.update_document_properties
+        """
+        filled = {}
+        for group_name, specs in self.groups:
+            filled[group_name] = {}
+            for spec in specs:
+                meta = filled[group_name][spec.name] = dict(spec.meta)
+                if spec.name in values:
+                    meta['value'] = values[spec.name]
+        return filled
+
+    def fill_groups(self, values, document_client):
+        """
+        :param values: dict of property name : value
+        :param document_client: client.Document used to build the skeletons the first time
+        :returns list of groupProperties objects
+        """
+        property_groups = []
+        for group_name, group, properties in self.get_skeletons(document_client):
+            group = copy.deepcopy(group)
+            for spec, property in properties:
+                if spec.name in values:
+                    property = copy.deepcopy(property)
+                    property.values = [values[spec.name]]
+                    group.properties.append(property)
+            property_groups.append(group)
+        return property_groups
+
+    def get_skeletons(self, document_client):
+        with self._lock:
+            if self._skeletons is None:
+                skeletons = []
+                for group_name, specs in self.groups:
+                    group = document_client.create_group_properties_object()
+                    group.groupName = group_name
+                    properties = []
+                    for spec in specs:
+                        property = document_client.create_group_property_object()
+                        property.name = spec.name
+                        properties.append((spec, property))
+                    skeletons.append((group_name, group, tuple(properties)))
+                self._skeletons = tuple(skeletons)
+            return self._skeletons
+
+
 class SyncProperties(object):
 
-    def __init__(self):
-        self.property = facades.Property()
-        self.property_group = client.PropertyGroup()
+    property = client.LazyService(facades.Property)
+    property_group = client.LazyService(client.PropertyGroup)
+    document_client = client.LazyService(client.Document)
 
-    def prepare_properties_dict(self, map, document):
+    def get_property_values(self, document):
         """
         @todo pass getter functions in to get the values
         :param document: Django model object instance
-        :returns dict
+        :returns dict of property name : value
         """
-        map['okg:customProperties']['okp:customProperties.title'] = [document.name]
-        map['okg:customProperties']['okp:customProperties.description'] = [document.description]
-        map['okg:customProperties']['okp:customProperties.languages'] = [self.get_language(document)]
-
-        map['okg:salesProperties']['okp:salesProperties.assetType'] = [self.get_asset_type(document)]
-
-        map['okg:gsaProperties']['okp:gsaProperties.gsaPublishedStatus'] = [self.get_published_status(document)]
-        map['okg:gsaProperties']['okp:gsaProperties.startDate'] = [document.okm_date_string(document.publish)]
-        map['okg:gsaProperties']['okp:gsaProperties.expirationDate'] = [document.okm_date_string(document.expire)]
-        return map
+        return {
+            'okp:customProperties.title': document.name,
+            'okp:customProperties.description': document.description,
+            'okp:customProperties.languages': self.get_language(document),
+            'okp:salesProperties.assetType': self.get_asset_type(document),
+            'okp:gsaProperties.gsaPublishedStatus': self.get_published_status(document),
+            'okp:gsaProperties.startDate': document.okm_date_string(document.publish),
+            'okp:gsaProperties.expirationDate': document.okm_date_string(document.expire),
+        }
+
+    def prepare_properties_dict(self, document):
+        """
+        :param document: Django model object instance
+        :returns dict of the form { group name : { property name : [value], ... } }
+        """
+        return PropertyGroupTemplates.get().fill_values(self.get_property_values(document))
 
     def get_language(self, document):
         if not hasattr(document, 'language') or not hasattr(document.language, 'language') or document.language.language in ('ro', 'hr') or not document.language:
@@ -216,11 +366,10 @@ class SyncProperties(object):
         """
         property_groups = []
         for property_group in properties_dict:
-            document = client.Document()
-            property_group_obj = document.create_group_properties_object()
+            property_group_obj = self.document_client.create_group_properties_object()
             property_group_obj.groupName = property_group
             for property_name, value in properties_dict[property_group].items():
-                property_obj = document.create_group_property_object()
+                property_obj = self.document_client.create_group_property_object()
                 property_obj.name = property_name
                 property_obj.values = [value]
                 property_group_obj.properties.append(property_obj)
@@ -228,25 +377,47 @@ class SyncProperties(object):
 
         return property_groups
 
+    def django_to_openkm(self, document):
+        """
+        Writes the document's values to each of the property groups in the OPENKM settings,
+        adding any group the document doesn't have yet.  The groups are read, and then written,
+        all at once
+        :param document: Django model object instance
+        """
+        property_map = self.populate_property_group_map(document)
+        existing_groups = self.property.get_group_names(document.okm_path)
+        for group_name in property_map:
+            if group_name not in existing_groups:
+                self.property_group.add_group(document.okm_path, group_name)
+
+        groups = self.property.get_groups_properties(document.okm_path, property_map.keys())
+        for group_name, properties in groups.items():
+            groups[group_name] = self.property.update_document_properties(properties, property_map[group_name])
+        self.property.set_groups_properties(document.okm_path, groups)
+
     def django_to_openkm_improved(self, document):
-        map = settings.OPENKM['properties']
-        properties_dict = self.prepare_properties_dict(map, document)
-        return self.populate_property_group(properties_dict)
+        return PropertyGroupTemplates.get().fill_groups(self.get_property_values(document), self.document_client)
 
     def openkm_to_django(self, document):
+        if self.apply_openkm_properties(document):
+            document.save()
+
+    def apply_openkm_properties(self, document):
+        """
+        Sets the document's attributes from its property groups on OpenKM, without saving it
+        :returns True if the document has any property groups
+        """
         self.PROPERTY_GROUP_MAP = settings.OPENKM['properties']
-        document_property_groups = self.property.get_property_groups_for_document(document.okm_path)
+        group_names = self.property.get_group_names(document.okm_path)
+        if not group_names:
+            return False
 
-        if document_property_groups:
-            for property_group in document_property_groups[0]:
-                if hasattr(property_group, 'name') and property_group.name != 'okg:gsaProperties':
-                    document_properties = self.property.get_document_properties_for_group(document.okm_path, property_group.name)
-                    try:
-                        property_map = self.PROPERTY_GROUP_MAP[property_group.name]
-                        document = self.set_attributes(property_map, document_properties[0], document)
-                    except KeyError, e:
-                        print e
-            document.save()
+        # only the configured groups are read, all at once
+        group_names = [name for name in group_names if name != 'okg:gsaProperties' and name in self.PROPERTY_GROUP_MAP]
+        groups = self.property.get_groups_properties(document.okm_path, group_names)
+        for group_name in sorted(groups):
+            document = self.set_attributes(self.PROPERTY_GROUP_MAP[group_name], groups[group_name][0], document)
+        return True
 
     def set_attributes(self, property_map, document_properties, document):
         for document_property in document_properties:
@@ -256,7 +427,7 @@ class SyncProperties(object):
                     if 'choices' in meta:
                         option = self.get_option(document_property.options)
                         if option and meta['choices']:
-                            value = utils.find_key(dict(meta['choices']), option.label)
+                            value = self.get_choice_index(meta).get_key(option.label)
                             setattr(document, meta['attribute'], value)
                         elif option and not meta['choices']:
                             if meta['attribute'] == 'type':
@@ -275,6 +446,12 @@ class SyncProperties(object):
                         setattr(document, meta['attribute'], document_property.value)
         return document
 
+    def get_choice_index(self, meta):
+        """ The index built by Settings, or a new one for choices which weren't configured through it """
+        if 'choice_index' not in meta:
+            return utils.ChoiceIndex(meta['choices'], meta.get('fold_case', False))
+        return meta['choice_index']
+
     def set_language(self, document, option):
         language_model_class = document.get_related_model()
         document.language = language_model_class.objects.get(language=option.value)
@@ -284,35 +461,11 @@ class SyncProperties(object):
             if option.selected:
                 return option
 
-    def populate_property_group_map(self, map, document):
+    def populate_property_group_map(self, document):
         """
-        Updates the settings dict with values.
-        @todo this restricts the settings. abstract to more generic
+        :returns a copy of the property settings with the document's values added
         """
-        map['okg:customProperties']['okp:customProperties.title'].update({'value': document.name})
-        map['okg:customProperties']['okp:customProperties.description'].update({'value': document.description})
-
-        # must set to english languages not supported in OpenKM
-        if document.language.language in ('ro', 'hr') or not document.language:
-            language = 'en'
-        else:
-            language = document.language.language
-        map['okg:customProperties']['okp:customProperties.languages'].update({'value': language})
-
-
-        parts = document.type.name.split()
-        parts[0] = parts[0].lower()
-        asset_type = ''.join(parts)
-        map['okg:salesProperties']['okp:salesProperties.assetType'].update({'value': asset_type})
-
-        # published status has two values that GSA should set
-        gsaPublishedStatus = 'Not Published'
-        if document.is_published:
-            gsaPublishedStatus = 'Published'
-        map['okg:gsaProperties']['okp:gsaProperties.gsaPublishedStatus'].update({'value': gsaPublishedStatus})
-        map['okg:gsaProperties']['okp:gsaProperties.startDate'].update({'value': document.okm_date_string(document.publish)})
-        map['okg:gsaProperties']['okp:gsaProperties.expirationDate'].update({'value': document.okm_date_string(document.expire)})
-        return map
+        return PropertyGroupTemplates.get().fill_map(self.get_property_values(document))
 
 
 class SyncFolderList(object):
@@ -323,23 +476,44 @@ class SyncFolderList(object):
     """
     DIRECTORY_SEPARATOR = "/"
 
-    def __init__(self):
-        self.category = facades.Category()
-        self.dir = facades.DirectoryListing()
-        self.repository = client.Repository()
+    category = client.LazyService(facades.Category)
+    dir = client.LazyService(facades.DirectoryListing)
+    repository = client.LazyService(client.Repository)
+
+    # rows written by each INSERT statement when saving the folder list
+    BATCH_SIZE = 500
+    # held while okm_created's auto_now_add is switched off for a bulk insert
+    created_date_lock = threading.Lock()
+    # folder list fields compared by an incremental sync to find changed folders
+    CHANGE_FIELDS = ('okm_path', 'okm_permissions', 'okm_has_childs', 'okm_category', 'okm_name')
 
-    def execute(self, klass):
+    def execute(self, klass, incremental=False):
         """
+        Refreshes the local folder list from the folders currently on OpenKM.  By default the
+        list is replaced, keeping the old list until the new one has been written.  An
+        incremental refresh only writes the folders which have been added, changed or removed
         :param klass: OpenKMFolderlist class object
+        :param incremental: bool
+        :returns dict of the number of folders created, updated, deleted and unchanged
         """
-        klass.objects.all().delete()
         xpath_query = '/jcr:root/okm:categories//element(*)'
         search = facades.SearchManager()
         type = 'xpath'
         folders = search.by_statement(xpath_query, type)
         print('%s folders returned for query: %s' % (len(folders.item), xpath_query))
-        self.save(folders, klass)
+        with transaction.commit_on_success():
+            if incremental:
+                counts = self.update(folders, klass)
+            else:
+                counts = {'deleted': klass.objects.count(), 'updated': 0, 'unchanged': 0}
+                klass.objects.all().delete()
+                counts['created'] = self.save(folders, klass)
+        # other processes pick up the changes when their trie times out
+        klass.objects.refresh_category_trie()
+        print('%(created)s folders created, %(updated)s updated, %(deleted)s deleted, '
+              '%(unchanged)s unchanged' % counts)
         print('%s folders now in local folder list' % klass.objects.count())
+        return counts
 
     def get_list_of_root_paths(self):
         return [self.category.get_category_root().path]
@@ -353,27 +527,143 @@ class SyncFolderList(object):
 
     def save(self, folders, klass):
         """
-        Iterate over the returned
+        Writes the folders returned by a search to the folder list with bulk inserts.
+        Call inside a transaction, as execute() does, so the list is never seen half written
+        """
+        objects = self.get_folder_list_objects(folders, klass)
+        self.bulk_create(objects, klass)
+        return len(objects)
+
+    def update(self, folders, klass):
+        """
+        Diffs the folders returned by a search against the folder list by uuid, then inserts
+        new folders, updates folders whose CHANGE_FIELDS differ and deletes folders which are
+        no longer on OpenKM.  Call inside a transaction, as execute() does
+        :returns dict of the number of folders created, updated, deleted and unchanged
+        """
+        incoming = dict((obj.okm_uuid, obj) for obj in self.get_folder_list_objects(folders, klass))
+        existing = {}
+        deleted = []
+        for row in klass.objects.values('pk', 'okm_uuid', *self.CHANGE_FIELDS):
+            if row['okm_uuid'] in incoming and row['okm_uuid'] not in existing:
+                existing[row['okm_uuid']] = row
+            else:
+                # removed from OpenKM, or a duplicate left by an earlier sync
+                deleted.append(row['pk'])
+
+        created = [obj for uuid, obj in incoming.items() if uuid not in existing]
+        updated = [(existing[uuid]['pk'], obj) for uuid, obj in incoming.items()
+                   if uuid in existing and self.has_changed(existing[uuid], obj)]
+
+        for start in range(0, len(deleted), self.BATCH_SIZE):
+            klass.objects.filter(pk__in=deleted[start:start + self.BATCH_SIZE]).delete()
+        for pk, obj in updated:
+            klass.objects.filter(pk=pk).update(**dict((field, getattr(obj, field)) for field in self.CHANGE_FIELDS))
+        self.bulk_create(created, klass)
+
+        return {'created': len(created),
+                'updated': len(updated),
+                'deleted': len(deleted),
+                'unchanged': len(existing) - len(updated)}
+
+    def has_changed(self, row, obj):
+        """
+        :param row: dict of folder list values as stored
+        :param obj: unsaved folder list object built from OpenKM
+        """
+        for field in self.CHANGE_FIELDS:
+            # the fields are CharFields, so OpenKM's ints and bools are stored as strings
+            value = getattr(obj, field)
+            if row[field] != (None if value is None else unicode(value)):
+                return True
+        return False
+
+    def bulk_create(self, objects, klass):
+        # okm_created is auto_now_add, which would replace the OpenKM date with the time of the sync
+        field = klass._meta.get_field('okm_created')
+        with self.created_date_lock:
+            auto_now_add, field.auto_now_add = field.auto_now_add, False
+            try:
+                for start in range(0, len(objects), self.BATCH_SIZE):
+                    klass.objects.bulk_create(objects[start:start + self.BATCH_SIZE])
+            finally:
+                field.auto_now_add = auto_now_add
+
+    def get_folder_list_objects(self, folders, klass):
+        """
+        Maps the folders returned by a search to unsaved folder list objects
+        :returns list of klass instances
         """
+        objects = []
         if hasattr(folders, 'item') and isinstance(folders.item, list):
             for folder in folders.item:
                 if hasattr(folder, 'folder'):
-                    folder = folder.folder
                     try:
-                        cl = klass.objects.create(okm_uuid=folder.uuid)
-                        cl.okm_author = folder.author
-                        cl.okm_created = folder.created
-                        cl.okm_has_childs = folder.hasChilds
-                        cl.okm_path = folder.path
-                        cl.okm_permissions = folder.permissions
-                        cl.okm_subscribed = folder.subscribed
-                        cl.save()
+                        objects.append(self.get_folder_list_object(folder.folder, klass))
                     except UnicodeEncodeError, e:
                         logging.exception(e)
                     except Exception, e:
                         logging.exception(e)
                 elif hasattr(folder, 'document'):
                     logging.error('This is a document, not a folder')
+        return objects
+
+    def get_folder_list_object(self, folder, klass):
+        # bulk_create doesn't call save(), so set the path index here
+        return klass(okm_uuid=folder.uuid,
+                     okm_author=folder.author,
+                     okm_created=folder.created,
+                     okm_has_childs=folder.hasChilds,
+                     okm_path=folder.path,
+                     okm_permissions=folder.permissions,
+                     okm_subscribed=folder.subscribed,
+                     **models.get_path_index(folder.path))
+
+
+class DocumentFingerprint(object):
+    """
+    Hashes of each part of a document which is synced to OpenKM.  The fingerprint of the last
+    successful sync is stored in the document's okm_fingerprint field, so a sync can skip the
+    steps whose part hasn't changed.  A part hashed as None is treated as always changed
+    """
+    STEPS = ('file', 'keywords', 'categories', 'properties')
+    # stored alongside the steps: a hash of the file's name, size and modification time, so
+    # the file is only read and hashed again when one of them changes
+    FILE_STAT = 'filestat'
+
+    def __init__(self, hashes):
+        """
+        :param hashes: dict of { step : hash string or None }
+        """
+        self.hashes = hashes
+
+    @classmethod
+    def parse(cls, value):
+        """
+        :param value: string as stored in okm_fingerprint, or None
+        :returns DocumentFingerprint, or None if nothing was stored
+        """
+        if not value:
+            return None
+        return cls(dict(part.split('=', 1) for part in value.split(';')))
+
+    @classmethod
+    def hash(cls, value):
+        """ Hashes any JSON serialisable value, independently of dict ordering """
+        return hashlib.md5(json.dumps(value, sort_keys=True, default=unicode)).hexdigest()
+
+    def changed_steps(self, previous):
+        """
+        :param previous: DocumentFingerprint of the last sync, or None
+        :returns set of the steps whose hash differs
+        """
+        if previous is None:
+            return set(self.STEPS)
+        return set(step for step in self.STEPS
+                   if self.hashes.get(step) is None or self.hashes.get(step) != previous.hashes.get(step))
+
+    def __str__(self):
+        return ';'.join('%s=%s' % (key, self.hashes[key]) for key in self.STEPS + (self.FILE_STAT,) if self.hashes.get(key))
 
 
 class SyncDocumentException(Exception):
@@ -382,19 +672,22 @@ class SyncDocumentException(Exception):
 
 class SyncDocument(object):
     """
-    Syncs a document object to OpenKM
+    Syncs a document object to OpenKM.  Services are built on first use, so a sync
+    only pays for the clients it actually calls
     @todo refactor this to strip out any functionality which should be elsewhere
     """
+    document = client.LazyService(client.Document)
+    document_manager = client.LazyService(facades.DocumentManager)
+    repository_manager = client.LazyService(facades.RepositoryManager)
+    sync_keywords = client.LazyService(SyncKeywords)
+    keyword = client.LazyService(facades.Keyword)
+    sync_categories = client.LazyService(SyncCategories)
+    category = client.LazyService(facades.Category)
+    property = client.LazyService(facades.Property)
+    sync_properties = client.LazyService(SyncProperties)
+
     def __init__(self):
-        self.document = client.Document()
-        self.document_manager = facades.DocumentManager()
-        self.repository_manager = facades.RepositoryManager()
-        self.sync_keywords = SyncKeywords()
-        self.keyword = facades.Keyword()
-        self.sync_categories = SyncCategories()
-        self.category = facades.Category()
         self.upload_root = self.get_upload_root()
-        self.property = facades.Property()
 
     def get_upload_root(self):
         return settings.OPENKM['configuration']['UploadRoot']
@@ -404,24 +697,119 @@ class DjangoToOpenKm(SyncDocument):
 
     def execute(self, document, folderlist_document_class, taxonomy=False):
         """
-        Uploads a document to OpenKm
+        Uploads a document to OpenKm, logging rather than raising any error
         :param document: a document object
         :param document_class: a class object.  This should be your Django model which extends the OpenKmDocument
         abstract base class
         """
         try:
-            logger.debug(document)
-            if not document.okm_uuid and document.file:
-                if taxonomy:
-                    taxonomy = self.build_taxonomy(document)
-                okm_document = self.document_manager.create(document.file, taxonomy)
-                document.set_model_fields(okm_document)
-                document.save()
+            with outbound.suppressed():
+                self.sync(document, folderlist_document_class, taxonomy)
+        except Exception, e:
+            logger.exception(e)
+
+    def sync(self, document, folderlist_document_class, taxonomy=False, force=False):
+        """
+        Uploads a document to OpenKm, then writes its keywords, categories and properties.  Steps
+        whose part of the document is unchanged since the last successful sync are skipped
+        :param force: bool run every step regardless of the document's fingerprint
+        :raises any error from OpenKM
+        """
+        logger.debug(document)
+        previous = DocumentFingerprint.parse(document.okm_fingerprint)
+        fingerprint = self.get_fingerprint(document, previous)
+        changed = set(DocumentFingerprint.STEPS) if force else fingerprint.changed_steps(previous)
+
+        if not document.okm_uuid and document.file:
+            if taxonomy:
+                taxonomy = self.build_taxonomy(document)
+            okm_document = self.document_manager.create(document.file, taxonomy)
+            document.set_model_fields(okm_document)
+            document.save()
+            changed = set(DocumentFingerprint.STEPS)
+        elif 'file' in changed and previous is not None and document.okm_uuid and document.file:
+            # without a stored fingerprint there's nothing to say the file differs from OpenKM's copy
+            self.update_content(document)
+
+        if 'keywords' in changed:
             self.keywords(document)
+        if 'categories' in changed:
             self.categories(document, folderlist_document_class)
+        if 'properties' in changed:
             self.properties(document)
+        self.set_fingerprint(document, fingerprint)
+
+    def get_fingerprint(self, document, previous=None):
+        """
+        :param previous: DocumentFingerprint of the last sync, whose file hash is reused if the
+        file's name, size and modification time are unchanged
+        """
+        file_stat = self._get_hash(self.get_file_stat, document)
+        if file_stat and previous is not None and previous.hashes.get(DocumentFingerprint.FILE_STAT) == file_stat \
+                and previous.hashes.get('file'):
+            file_hash = previous.hashes['file']
+        else:
+            file_hash = self._get_hash(self.get_file_hash, document)
+        return DocumentFingerprint({
+            'file': file_hash,
+            'keywords': self._get_hash(self.get_keywords_value, document),
+            'categories': self._get_hash(self.get_categories_value, document),
+            'properties': self._get_hash(self.get_properties_value, document),
+            DocumentFingerprint.FILE_STAT: file_stat,
+        })
+
+    def _get_hash(self, get_value, document):
+        try:
+            return get_value(document)
         except Exception, e:
+            # the step will run on every sync rather than fail the document
             logger.exception(e)
+            return None
+
+    def get_file_stat(self, document):
+        """ Hashes the file's name, size and modification time, read from its storage without opening it """
+        if not document.file:
+            return None
+        storage = document.file.storage
+        name = document.file.name
+        return DocumentFingerprint.hash([name, storage.size(name), storage.modified_time(name)])
+
+    def get_file_hash(self, document):
+        if not document.file:
+            return DocumentFingerprint.hash(None)
+        return utils.hash_file(document.file)
+
+    def get_keywords_value(self, document):
+        tags = self.sync_keywords.get_tags_from_document(document)
+        return DocumentFingerprint.hash(sorted(set(tag.strip() for tag in tags if tag.strip())))
+
+    def get_categories_value(self, document):
+        categories = {}
+        for related_model_class in settings.OPENKM['categories'].keys():
+            objects = self.sync_categories.get_objects_from_m2m_model(document, related_model_class)
+            categories[related_model_class.__name__] = sorted(objects.values_list('pk', flat=True))
+        return DocumentFingerprint.hash(categories)
+
+    def get_properties_value(self, document):
+        properties = self.sync_properties.prepare_properties_dict(document)
+        return DocumentFingerprint.hash(properties)
+
+    def set_fingerprint(self, document, fingerprint):
+        document.okm_fingerprint = str(fingerprint)
+        document.okm_synced = datetime.datetime.now()
+        # update rather than save, so only these fields are written and no save signals are sent
+        type(document)._default_manager.filter(pk=document.pk).update(
+            okm_fingerprint=document.okm_fingerprint, okm_synced=document.okm_synced)
+
+    def update_content(self, document):
+        """ Checks in the document's file as a new version of the document on OpenKM """
+        self.document.checkout(document.okm_path)
+        try:
+            self.document.set_content(document.okm_path, self.document.stream_content(document.file))
+        except:
+            self.document.cancel_checkout(document.okm_path)
+            raise
+        self.document.checkin(document.okm_path)
 
     def improved_execute(self, document, openkm_folderlist_class, taxonomy=False):
         CustomDjangoToOpenKM(asset=document).execute(openkm_folderlist_class, taxonomy=False)
@@ -438,8 +826,7 @@ class DjangoToOpenKm(SyncDocument):
         :param document_class: a class object.  This should be your Django model which extends the OpenKmDocument
         abstract base class
         """
-        sync_properties = SyncProperties()
-        sync_properties.django_to_openkm(document)
+        self.sync_properties.django_to_openkm(document)
 
     def build_taxonomy(self, document):
         """
@@ -466,17 +853,24 @@ class DjangoToOpenKm(SyncDocument):
     def keywords(self, document):
         """
         TAGS -> KEYWORDS
-        Writes the tags to OpenKM as keywords and confirms that they have been added
-        :returns boolean:  True on success, False on fail
+        Writes the tags to OpenKM as keywords, adding and removing only the keywords which differ
+        :returns boolean:  True on success
         """
         tags = self.sync_keywords.get_tags_from_document(document)
-#        logger.info("[GSA] Tags: %s", tags)
-        self.sync_keywords.write_keywords_to_openkm_document(document.okm_path, tags)
-        print("[GSA] Tags: %s", tags)
-        return self.sync_keywords.confirm_keywords_written_to_openkm(document.okm_path, tags)
+        added, removed = self.sync_keywords.write_keywords_to_openkm_document(document.okm_path, tags)
+        logger.debug("[GSA] Tags: %s, added %s, removed %s", tags, list(added), list(removed))
+        # the writes raise on failure, so there's no need to read the keywords back
+        return True
 
     def get_category_uuids(self, document, openkm_folderlist_class):
-        category_uuids = []
+        return [uuid for uuid, path in self.get_category_folders(document, openkm_folderlist_class)]
+
+    def get_category_folders(self, document, openkm_folderlist_class):
+        """
+        Returns (uuid, path) tuples of the category folders that match the categories of the document,
+        resolved from the folder list's in-memory category trie
+        """
+        folders = []
         for related_model_class in settings.OPENKM['categories'].keys():
             # prepare the lists of AND and OR predicates for the query
             mapped_category_name = self.category_map(related_model_class.__name__)
@@ -487,11 +881,8 @@ class DjangoToOpenKm(SyncDocument):
             fields = self.sync_categories.get_objects_from_m2m_model(document, related_model_class)
             or_predicates = [field.__unicode__() for field in fields]
 
-            # @todo convert '/' chars to '--' in and_predicates and or_predicate lists
-
-            # get the category UUIDs
-            category_uuids += openkm_folderlist_class.objects.custom_path_query(and_predicates, or_predicates)
-        return category_uuids
+            folders += openkm_folderlist_class.objects.get_category_folders(and_predicates, or_predicates)
+        return folders
 
     def get_categories(self, document, openkm_folderlist_class):
         """
@@ -509,31 +900,50 @@ class DjangoToOpenKm(SyncDocument):
             fields = self.sync_categories.get_objects_from_m2m_model(document, related_model_class)
             or_predicates = [field.__unicode__() for field in fields]
 
-            # @todo convert '/' chars to '--' in and_predicates and or_predicate lists
-
             # get the category UUIDs
             categories += openkm_folderlist_class.objects.get_custom_queryset(and_predicates, or_predicates)
         return categories
 
     def categories(self, document, openkm_folderlist_class, update_individually=True):
         """
-        Using the MODEL_CATEGORY_MAP gets all the associated objects for each m2m relationship and adds
-        them as categories to the given document on OpenKM
+        Using the MODEL_CATEGORY_MAP gets all the associated objects for each m2m relationship and makes
+        them the categories of the given document on OpenKM, adding and removing only the categories which differ
         :param document_class: a class object.  This should be your Django model which extends the OpenKmDocument
         abstract base class
+        :returns facades.CategoryChanges, or None if update_individually is False
         """
         category_uuids = self.get_category_uuids(document, openkm_folderlist_class)
+        trie = openkm_folderlist_class.objects.get_category_trie()
+        if getattr(document, 'is_linked_asset', None) and document.is_linked_asset():
+            # as CustomDjangoToOpenKM.add_categories, the source document's folder is kept
+            source_uuid = trie.get_uuid(document.get_dms_source_path())
+            if source_uuid:
+                category_uuids.append(source_uuid)
 
         if update_individually:
-            # add the categories to the document
-            for category_uuid in category_uuids:
-                logger.info("Adding category [%s] to %s" % (category_uuid, document.okm_path))
-                self.category.add_to_node(document.okm_path, category_uuid)
+            changes = self.category.set_for_node(document.okm_path, category_uuids, self.get_removable_category(trie))
+            logger.info("Categories of %s: added %s, removed %s in %.3fs", document.okm_path, list(changes.added),
+                        list(changes.removed), sum(seconds for method_name, uuid, seconds in changes.timings))
+            return changes
+
+
+    def get_removable_category(self, trie):
+        """
+        Only the categories this sync manages may be removed from a document: folders below one of
+        the mapped category roots which the category trie knows.  Anything else, eg. a category
+        added by hand on OpenKM, or a folder newer than the trie, is left alone
+        :returns function of (uuid, path) returning bool
+        """
+        roots = tuple('/okm:categories/%s/' % self.category_map(related_model_class.__name__).lower()
+                      for related_model_class in settings.OPENKM['categories'].keys()
+                      if self.category_map(related_model_class.__name__))
 
+        def is_removable(uuid, path):
+            return path.lower().startswith(roots) and trie.get_uuid(path) == uuid
+        return is_removable
 
     def properties(self, document):
-        sync_properties = SyncProperties()
-        sync_properties.django_to_openkm(document)
+        self.sync_properties.django_to_openkm(document)
 
     map = {
         'Industry': 'Industries',
@@ -552,17 +962,142 @@ class DjangoToOpenKm(SyncDocument):
             return False
 
 
+class SyncReport(object):
+    """
+    Counts the documents synced by a bulk sync, and records the ones which failed
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.synced = 0
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def add_success(self, document):
+        with self._lock:
+            self.synced += 1
+
+    def add_failure(self, document, error):
+        with self._lock:
+            self.failures.append((document.pk, error))
+
+    def finish(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def throughput(self):
+        """ documents processed per second """
+        elapsed = self.elapsed
+        return (self.synced + len(self.failures)) / elapsed if elapsed else 0.0
+
+    def __str__(self):
+        return '%s documents synced, %s failed in %.1fs (%.1f documents/s)' % (
+            self.synced, len(self.failures), self.elapsed, self.throughput)
+
+
+class BulkDjangoToOpenKm(object):
+    """
+    Syncs a queryset of documents to OpenKM across a pool of worker threads.  Each worker has its
+    own DjangoToOpenKm, and so its own suds clients, while the parsed WSDLs and session tokens are
+    shared through client.registry and client.sessions.  A document which fails with a network
+    error is retried with exponential backoff; a document which still fails is recorded in the
+    report and the rest carry on
+    """
+    # errors which may succeed on a retry.  Expired sessions are already renewed by the client
+    RETRY_EXCEPTIONS = (TransportError, urllib2.URLError, socket.error)
+
+    def __init__(self, workers=None, retries=None, backoff=None):
+        """
+        :param workers: int number of threads, defaults to the SyncWorkers setting
+        :param retries: int retries of a document after a network error, defaults to SyncRetries
+        :param backoff: seconds before the first retry, doubled for each one after, defaults to SyncRetryBackoff
+        """
+        configuration = settings.OPENKM['configuration']
+        self.workers = workers or configuration.get('SyncWorkers', 4)
+        self.retries = retries if retries is not None else configuration.get('SyncRetries', 2)
+        self.backoff = backoff if backoff is not None else configuration.get('SyncRetryBackoff', 1)
+
+    def execute(self, queryset, folderlist_document_class, taxonomy=False):
+        """
+        :param queryset: queryset of instances of an OpenKmDocument subclass
+        :param folderlist_document_class: your Django model which extends OpenKmFolderList
+        :returns SyncReport
+        """
+        report = SyncReport()
+        # bounded, so documents are read from the database only as fast as they are synced
+        documents = Queue.Queue(maxsize=self.workers * 2)
+        threads = [threading.Thread(target=self.work, args=(documents, folderlist_document_class, taxonomy, report))
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for document in queryset.iterator():
+                documents.put(document)
+        finally:
+            for thread in threads:
+                documents.put(None)
+            for thread in threads:
+                thread.join()
+
+        report.finish()
+        logger.info(report)
+        return report
+
+    def work(self, documents, folderlist_document_class, taxonomy, report):
+        syncer = DjangoToOpenKm()
+        try:
+            # the sync saves each document, which mustn't queue it to be synced again
+            with outbound.suppressed():
+                while True:
+                    document = documents.get()
+                    if document is None:
+                        break
+                    self.sync_document(syncer, document, folderlist_document_class, taxonomy, report)
+        finally:
+            # Django opens a database connection per thread
+            connection.close()
+
+    def sync_document(self, syncer, document, folderlist_document_class, taxonomy, report):
+        attempt = 0
+        while True:
+            try:
+                syncer.sync(document, folderlist_document_class, taxonomy)
+            except self.RETRY_EXCEPTIONS, e:
+                if attempt < self.retries:
+                    delay = self.backoff * 2 ** attempt
+                    attempt += 1
+                    logger.warning('Retrying %s in %ss after: %s', document, delay, e)
+                    time.sleep(delay)
+                    continue
+                logger.error('Giving up on %s after %s attempts: %s', document, attempt + 1, e)
+                report.add_failure(document, e)
+            except Exception, e:
+                logger.exception(e)
+                report.add_failure(document, e)
+            else:
+                report.add_success(document)
+            return
+
+
 class CustomDjangoToOpenKM(DjangoToOpenKm):
     """
     Calls methods from a customised non-standard version of OpenKM
     DO NOT USE these methods if you are using a standard OpenKM instance
     """
+    document_client = client.LazyService(client.Document)
+
     def __init__(self, asset, *args, **kwargs):
         """
         :param asset: Django model object instance that inherits from OpenKMDocument
         """
         self.asset = asset
-        self.document_client = client.Document()
         super(CustomDjangoToOpenKM, self).__init__(*args, **kwargs)
 
     def get_data(self):
@@ -588,19 +1123,18 @@ class CustomDjangoToOpenKM(DjangoToOpenKm):
 
 
     def add_categories(self, openkm_folderlist_class):
-        categories = []
-        categories = self.get_categories(self.asset, openkm_folderlist_class)
+        paths = [path for uuid, path in self.get_category_folders(self.asset, openkm_folderlist_class)]
         if self.asset.is_linked_asset():
             source_path = self.asset.get_dms_source_path()
-            categories += openkm_folderlist_class.objects.filter(okm_path=source_path)
-        return [self.document_client.create_category_folder_object(c.okm_path) for c in categories]
+            if openkm_folderlist_class.objects.get_category_trie().get_uuid(source_path):
+                paths.append(source_path)
+        return [self.document_client.create_category_folder_object(path) for path in paths]
 
     def add_properties(self):
-        sync_properties = SyncProperties()
-        return sync_properties.django_to_openkm_improved(self.asset)
+        return self.sync_properties.django_to_openkm_improved(self.asset)
 
     def create(self, data):
-        content = facades.DocumentManager().convert_file_content_to_binary_for_transport(self.asset.file)
+        content = self.document_client.stream_content(self.asset.file)
         okm_document = self.document_client.create_document(content, data)
         return okm_document
 
@@ -635,30 +1169,66 @@ class OpenKmToDjango(SyncDocument):
         :param document: A Django model object instance of your Document object
         :param okm_document: An OKM Document object as returned by a webservice
         '''
-        self.keywords(document, okm_document)
-        self.properties(document)
-        self.categories(document, okm_document)
+        # the changes came from OpenKM, so they aren't queued to be synced back to it
+        with outbound.suppressed():
+            self.keywords(document, okm_document)
+            self.properties(document)
+            self.categories(document, okm_document)
 
     def keywords(self, document, okm_document):
         '''
         :param document: a Django model instance for your document
         :param okm_document: an OpenKM Document instance
         '''
-        if hasattr(okm_document, 'keywords') and okm_document.keywords:
-            print 'DMS Keywords: %s' % okm_document.keywords
-            keywords = utils.remove_none_elements_from_list(okm_document.keywords)
-            document.tags = ', '.join(keywords)
-        else:
-            document.tags = ''
+        document.tags = self.get_tags(okm_document)
         document.save()
         print 'GSA tags: %s' % document.tags
 
+    def get_tags(self, okm_document):
+        if hasattr(okm_document, 'keywords') and okm_document.keywords:
+            print 'DMS Keywords: %s' % okm_document.keywords
+            keywords = utils.remove_none_elements_from_list(okm_document.keywords)
+            return ', '.join(keywords)
+        return ''
 
     def categories(self, document, okm_document):
         '''
         :param document: a Django model instance for your document
         :param okm_document: an OpenKM Document instance
         '''
+        category_bin = self.get_category_bin(okm_document)
+        print 'Category bin: ', category_bin
+
+        for related_class, values in category_bin.items():
+            try:
+                self.set_related_objects(document, related_class, values)
+            except Exception, e:
+                print e
+                logger.exception(e)
+
+    def set_related_objects(self, document, related_class, values):
+        """
+        Makes the objects named by values the document's related objects of related_class.  The
+        values are resolved in one query, and only the relations which differ are added or removed
+        :param values: list of related object names
+        :returns (set of pks added, set of pks removed)
+        """
+        _set = getattr(document, related_class.__name__.lower()) # get the m2m manager
+        objects = self.sync_categories.get_related_objects(related_class, set(values))
+        expected = set(object.pk for object in objects.values())
+        current = set(_set.values_list('pk', flat=True))
+        added, removed = expected - current, current - expected
+        if removed:
+            _set.remove(*removed)
+        if added:
+            _set.add(*added)
+        return added, removed
+
+    def get_category_bin(self, okm_document):
+        '''
+        :param okm_document: an OpenKM Document instance
+        :returns dict of { related class to the document : list of values } for the document's categories
+        '''
         category_bin = {}
 
         # add the categories from OpenKM to the dict
@@ -668,35 +1238,17 @@ class OpenKmToDjango(SyncDocument):
                     category_name, object_name = utils.get_category_from_path(category.path) # find the category
 
                     # use the map to translate the OKM category name to the Django model name
-                    sync_categories = SyncCategories()
-                    model_name = utils.find_key(sync_categories.map, category_name)
+                    model_name = SyncCategories.map_index.get_key(category_name)
 
                     category_bin = self.add_category_to_dict(model_name, object_name, category_bin)
                 except ValueError, e:
                     logger.exception(e)
 
-            print 'Category bin: ', category_bin
-
-            for related_class, values in category_bin.items():
-                try:
-                    # get the related manager for the class
-                    _set = getattr(document, "%s" % related_class.__name__.lower()) # get the m2m manager
-                    _set.clear() # remove the current objects
-
-                    # special case for Tasks. this would be better as one to one, but need to maps to the unicode val
-                    if related_class.__name__ == 'Task':
-                        values = [self.sanitize_task_description(value) for value in values]
-
-                    # get the objects and add them to the model
-                    objects = [related_class.objects.get(name__contains=value) for value in values]
-                    [_set.add(object) for object in objects]
-                except AttributeError, e:
-                    print e
-                    logger.exception(e)
-                except Exception, e:
-                    print e
-                    logger.exception(e)
-
+        for related_class, values in category_bin.items():
+            # special case for Tasks. this would be better as one to one, but need to maps to the unicode val
+            if related_class.__name__ == 'Task':
+                category_bin[related_class] = [self.sanitize_task_description(value) for value in values]
+        return category_bin
 
     def sanitize_task_description(self, task):
         p = re.compile('\[\w{0,4}\] [\d.: ]{0,9}')
@@ -711,7 +1263,7 @@ class OpenKmToDjango(SyncDocument):
         :param category_bin: dict
         :return dict
         """
-        related_class = utils.find_key(settings.OPENKM['categories'], category_name) # get the related class to document
+        related_class = self.get_related_class(category_name) # get the related class to document
 
         if not related_class:
             logger.error('%s not found in OPENKM[\'categories\']', category_name)
@@ -723,6 +1275,149 @@ class OpenKmToDjango(SyncDocument):
             category_bin[related_class].append(object_name)
         return category_bin
 
+    def get_related_class(self, category_name):
+        """
+        The related class mapped to category_name in OPENKM['categories'], or False.  The index is
+        built on first use, and kept for the rest of the run
+        """
+        if not hasattr(self, 'category_index'):
+            self.category_index = utils.ChoiceIndex(settings.OPENKM['categories'].items())
+        return self.category_index.get_key(category_name)
+
     def properties(self, document):
-        sync_properties = SyncProperties()
-        sync_properties.openkm_to_django(document)
+        self.sync_properties.openkm_to_django(document)
+
+
+class BulkOpenKmToDjango(object):
+    """
+    Pulls keywords, properties and categories from OpenKM for a queryset of documents.  The
+    OpenKM reads for a batch of documents run concurrently on a pool of threads, then the batch
+    is written in one transaction: one UPDATE of just the changed fields per document, and the
+    category relations replaced with one DELETE and one bulk INSERT per related model
+    """
+
+    sync_categories = client.LazyService(SyncCategories)
+
+    def __init__(self, workers=None, batch_size=None):
+        """
+        :param workers: int number of threads, defaults to the SyncWorkers setting
+        :param batch_size: int documents written per transaction, defaults to SyncBatchSize
+        """
+        configuration = settings.OPENKM['configuration']
+        self.workers = workers or configuration.get('SyncWorkers', 4)
+        self.batch_size = batch_size or configuration.get('SyncBatchSize', 100)
+        self.local = threading.local()
+
+    def execute(self, queryset):
+        """
+        :param queryset: queryset of instances of an OpenKmDocument subclass
+        :returns SyncReport
+        """
+        report = SyncReport()
+        pool = ThreadPool(self.workers)
+        try:
+            # the changes came from OpenKM, so they aren't queued to be synced back to it
+            with outbound.suppressed():
+                batch = []
+                for document in queryset.iterator():
+                    batch.append(document)
+                    if len(batch) == self.batch_size:
+                        self.sync_batch(pool, batch, report)
+                        batch = []
+                if batch:
+                    self.sync_batch(pool, batch, report)
+        finally:
+            pool.close()
+            pool.join()
+
+        report.finish()
+        logger.info(report)
+        return report
+
+    def sync_batch(self, pool, documents, report):
+        results = []
+        for document, result in zip(documents, pool.map(self.fetch, documents)):
+            if isinstance(result, Exception):
+                report.add_failure(document, result)
+            else:
+                results.append(result)
+
+        try:
+            with transaction.commit_on_success():
+                self.save_fields(results)
+                self.save_categories(results)
+        except Exception, e:
+            logger.exception(e)
+            for document, changed, category_bin in results:
+                report.add_failure(document, e)
+        else:
+            for document, changed, category_bin in results:
+                report.add_success(document)
+
+    def fetch(self, document):
+        """
+        Reads a document's meta data from OpenKM and applies it to the document in memory
+        :returns (document, dict of changed field values, category bin), or the error raised
+        """
+        try:
+            puller = self.get_puller()
+            okm_document = puller.document.get_current_properties(document.okm_path)
+            before = self.get_field_values(document)
+            document.tags = puller.get_tags(okm_document)
+            puller.sync_properties.apply_openkm_properties(document)
+            after = self.get_field_values(document)
+            changed = dict((name, value) for name, value in after.items() if before[name] != value)
+            return document, changed, puller.get_category_bin(okm_document)
+        except Exception, e:
+            logger.exception(e)
+            return e
+        finally:
+            # Django opens a database connection per thread, eg. for set_language's query
+            connection.close()
+
+    def get_puller(self):
+        # suds clients aren't thread safe, so each pool thread has its own
+        if not hasattr(self.local, 'puller'):
+            self.local.puller = OpenKmToDjango()
+        return self.local.puller
+
+    def get_field_values(self, document):
+        return dict((field.attname, getattr(document, field.attname))
+                    for field in document._meta.fields if not field.primary_key)
+
+    def save_fields(self, results):
+        for document, changed, category_bin in results:
+            if changed:
+                type(document)._default_manager.filter(pk=document.pk).update(**changed)
+
+    def save_categories(self, results):
+        # { (document class, related class) : { document pk : list of values } }
+        relations = {}
+        for document, changed, category_bin in results:
+            for related_class, values in category_bin.items():
+                relations.setdefault((type(document), related_class), {})[document.pk] = values
+
+        for (model_class, related_class), values_by_pk in relations.items():
+            try:
+                field = model_class._meta.get_field(related_class.__name__.lower())
+            except FieldDoesNotExist:
+                logger.error('%s has no many-to-many field for %s', model_class.__name__, related_class.__name__)
+                continue
+            self.replace_relations(field, related_class, values_by_pk)
+
+    def replace_relations(self, field, related_class, values_by_pk):
+        """
+        Replaces the related objects of many documents through a many-to-many field
+        :param values_by_pk: dict of { document pk : list of related object names }
+        """
+        objects = self.sync_categories.get_related_objects(related_class, set(itertools.chain(*values_by_pk.values())))
+        through = field.rel.through
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+
+        rows = []
+        for pk, values in values_by_pk.items():
+            related_pks = set(objects[value].pk for value in values if value in objects)
+            rows.extend(through(**{'%s_id' % source: pk, '%s_id' % target: related_pk}) for related_pk in related_pks)
+
+        through.objects.filter(**{'%s__in' % source: values_by_pk.keys()}).delete()
+        through.objects.bulk_create(rows)
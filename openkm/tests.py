@@ -1,11 +1,22 @@
+import os
+import base64
+import shutil
 import datetime
+import tempfile
+import threading
+import urllib2
+import StringIO
 
 from django.test import TestCase
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import DateTimeField
 
 import suds
+from suds.sudsobject import Object
+from suds.transport import TransportError
 
-import client, facades, models, sync, utils
+import cache, client, exceptions, facades, models, outbound, sync, transport, utils
 
 
 class ClientTest(TestCase):
@@ -24,6 +35,13 @@ class ClientTest(TestCase):
         """ Check fof the presence of the WSDL dict map """
         self.assertTrue(isinstance(client.OPENKM_WSDLS, dict))
 
+    def test_registry_parses_wsdl_once(self):
+        """ Clients handed out by the registry should be separate clones of one parsed WSDL """
+        first = client.get_client('Document')
+        second = client.get_client('Document')
+        self.assertFalse(first is second, msg="Registry should hand out a clone per caller")
+        self.assertTrue(first.wsdl is second.wsdl, msg="Clones should share the parsed WSDL")
+
 
 class FolderTest(TestCase):
 
@@ -88,6 +106,75 @@ class AuthTest(TestCase):
         pass
 
 
+class SessionPoolTest(TestCase):
+
+    def setUp(self):
+        self.pool = client.SessionPool(size=1)
+
+    def test_tokens_are_shared(self):
+        """ A pool of one should hand out the same token rather than logging in again """
+        self.assertEqual(self.pool.get_token(), self.pool.get_token())
+
+    def test_renew(self):
+        """ Renewing a stale token should replace it in the pool """
+        token = self.pool.get_token()
+        renewed = self.pool.renew(token)
+        self.assertNotEqual(token, renewed, msg="Token was not renewed")
+        self.assertEqual(renewed, self.pool.get_token(), msg="Pool still hands out the stale token")
+
+    def test_login_outside_lock(self):
+        """ A slow login shouldn't hold up another user, nor log the same user in twice """
+        started, finish = threading.Event(), threading.Event()
+        logins = []
+
+        def login(user, password):
+            logins.append(user)
+            if user == 'slow':
+                started.set()
+                finish.wait()
+            auth = Object()
+            auth.token = '%s-%s' % (user, logins.count(user))
+            return auth
+
+        self.pool._login = login
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(self.pool.get_token('slow', ''))) for i in range(2)]
+        threads[0].start()
+        started.wait()
+        threads[1].start()
+        self.assertEqual(self.pool.get_token('fast', ''), 'fast-1')
+        finish.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tokens, ['slow-1', 'slow-1'])
+        self.assertEqual(logins, ['slow', 'fast'])
+
+        self.assertEqual(self.pool.renew('slow-1', 'slow', ''), 'slow-2')
+        self.assertEqual(self.pool.renew('slow-1', 'slow', ''), 'slow-2')
+        self.assertEqual(logins, ['slow', 'fast', 'slow'])
+
+    def tearDown(self):
+        self.pool.close()
+
+
+class ExceptionParserTest(TestCase):
+
+    def get_fault(self, class_name, message):
+        detail = type(class_name, (object,), {})()
+        detail.message = message
+        e = Object()
+        e.fault = Object()
+        e.fault.detail = [detail]
+        return e
+
+    def test_is_session_expired(self):
+        parser = exceptions.ExceptionParser()
+        self.assertTrue(parser.is_session_expired(self.get_fault('LoginException', 'Login failed')))
+        self.assertTrue(parser.is_session_expired(self.get_fault('AccessDeniedException', 'Invalid token: abc')))
+        self.assertFalse(parser.is_session_expired(self.get_fault('AccessDeniedException', '/okm:root/private.pdf')))
+        self.assertFalse(parser.is_session_expired(self.get_fault('PathNotFoundException', 'Invalid token')))
+
+
 class DocumentTest(TestCase):
 
     test_doc_path = '%s%s' % (settings.OPENKM['configuration']['UploadRoot'], 'testing123.pdf')
@@ -158,7 +245,41 @@ class DocumentTest(TestCase):
 
 
 class PropertyTest(TestCase):
-    pass
+
+    class MockPropertyGroup(object):
+        def __init__(self):
+            self.calls = []
+
+        def get_groups(self, doc_path):
+            group, unnamed = Object(), Object()
+            group.name = 'okg:customProperties'
+            return [[group, unnamed]]
+
+        def get_properties(self, doc_path, group_name):
+            self.calls.append(('get_properties', doc_path, group_name))
+            return [[group_name]]
+
+        def set_properties(self, doc_path, group_name, properties):
+            self.calls.append(('set_properties', doc_path, group_name))
+
+    def setUp(self):
+        self.property = facades.Property()
+        self.property.property_group = self.MockPropertyGroup()
+
+    def test_get_language_label(self):
+        self.assertEqual('German', self.property.get_language_label('de'))
+        self.assertEqual('English', self.property.get_language_label('xx'))
+
+    def test_get_group_names(self):
+        self.assertEqual(set(['okg:customProperties']), self.property.get_group_names('/okm:root/a.pdf'))
+
+    def test_get_and_set_groups_properties(self):
+        groups = self.property.get_groups_properties('/okm:root/a.pdf', ['okg:customProperties'])
+        self.assertEqual({'okg:customProperties': [['okg:customProperties']]}, groups)
+        self.property.set_groups_properties('/okm:root/a.pdf', groups)
+        self.assertEqual([('get_properties', '/okm:root/a.pdf', 'okg:customProperties'),
+                          ('set_properties', '/okm:root/a.pdf', 'okg:customProperties')],
+                         self.property.property_group.calls)
 
 
 class PropertyGroupTest(TestCase):
@@ -312,6 +433,92 @@ class SyncKeywordsTest(TestCase):
         delete_test_document_on_openkm()
 
 
+class KeywordDiffTest(TestCase):
+
+    class MockKeyword(object):
+        def __init__(self, keywords):
+            self.keywords = keywords
+            self.writes = []
+
+        def get_for_document(self, path, cached=True):
+            return list(self.keywords)
+
+        def add(self, path, keyword):
+            self.writes.append(('add', keyword))
+
+        def remove(self, path, keyword):
+            self.writes.append(('remove', keyword))
+
+    def setUp(self):
+        self.sync_keywords = sync.SyncKeywords()
+
+    def test_unchanged_keywords_are_not_written(self):
+        self.sync_keywords.keyword = self.MockKeyword(['One', 'Two'])
+        self.sync_keywords.write_keywords_to_openkm_document('/okm:root/test.pdf', [u'One', u' Two'])
+        self.assertEqual([], self.sync_keywords.keyword.writes)
+
+    def test_only_differences_are_written(self):
+        self.sync_keywords.keyword = self.MockKeyword(['One', 'Stale'])
+        added, removed = self.sync_keywords.write_keywords_to_openkm_document('/okm:root/test.pdf', [u'One', u' Two', u''])
+        self.assertEqual(set(['Two']), added)
+        self.assertEqual(set(['Stale']), removed)
+        self.assertEqual(sorted([('add', 'Two'), ('remove', 'Stale')]), sorted(self.sync_keywords.keyword.writes))
+
+
+class CategoryDiffTest(TestCase):
+
+    class MockProperty(object):
+        def __init__(self):
+            self.writes = []
+
+        def add_category(self, path, uuid):
+            self.writes.append(('add', uuid))
+
+        def remove_category(self, path, uuid):
+            self.writes.append(('remove', uuid))
+
+    class MockDocument(object):
+        def get_current_properties(self, path):
+            properties = Object()
+            properties.categories = []
+            for uuid in ('uuid-1', 'uuid-stale'):
+                category = Object()
+                category.uuid, category.path = uuid, '/okm:categories/%s' % uuid
+                properties.categories.append(category)
+            return properties
+
+    def test_only_differences_are_written(self):
+        category = facades.Category()
+        category.property, category.document = self.MockProperty(), self.MockDocument()
+        changes = category.set_for_node('/okm:root/test.pdf', ['uuid-1', 'uuid-2'], lambda uuid, path: True)
+        self.assertEqual(set(['uuid-2']), changes.added)
+        self.assertEqual(set(['uuid-stale']), changes.removed)
+        self.assertEqual(sorted([('add', 'uuid-2'), ('remove', 'uuid-stale')]), sorted(category.property.writes))
+        self.assertEqual(2, len(changes.timings))
+
+    def test_unmanaged_categories_are_kept(self):
+        category = facades.Category()
+        category.property, category.document = self.MockProperty(), self.MockDocument()
+        changes = category.set_for_node('/okm:root/test.pdf', ['uuid-1'])
+        self.assertEqual(set(), changes.removed)
+        self.assertEqual([], category.property.writes)
+
+    def test_removable_category(self):
+        class MockTrie(object):
+            def get_uuid(self, path):
+                return {'/okm:categories/Region/EMEA': 'uuid-1'}.get(path)
+
+        class Region(object):
+            pass
+
+        configuration = dict(settings.OPENKM, categories={Region: 'Region'})
+        with self.settings(OPENKM=configuration):
+            is_removable = sync.DjangoToOpenKm().get_removable_category(MockTrie())
+        self.assertTrue(is_removable('uuid-1', '/okm:categories/Region/EMEA'))
+        self.assertFalse(is_removable('uuid-2', '/okm:categories/Region/APAC'))
+        self.assertFalse(is_removable('uuid-3', '/okm:categories/Handpicked/EMEA'))
+
+
 class CategoryTest(TestCase):
 
     def setUp(self):
@@ -360,6 +567,35 @@ class CategoryTest(TestCase):
                                                   (returned, expected))
 
 
+class LazyServiceTest(TestCase):
+
+    def test_services_built_on_first_use(self):
+        """ Facades should only build the clients a code path actually calls """
+        with client.ServiceCounter() as counter:
+            category = facades.Category()
+            self.assertEqual(counter.total, 0, msg="Services built on construction: %s" % counter.by_class)
+            category.get_category_root()
+            category.get_category_root()
+        self.assertEqual(counter.by_class, {'Repository': 1})
+
+
+class ServicePoolTest(TestCase):
+
+    def test_threads_keep_their_service(self):
+        built = []
+
+        def factory():
+            built.append(threading.current_thread())
+            return object()
+
+        pool = client.ServicePool(factory, 2)
+        for i in range(3):
+            results = pool.map(lambda service, item: (service, item * 2), range(8))
+            self.assertEqual([item for service, item in results], range(0, 16, 2))
+        self.assertTrue(len(built) <= 2, msg="Services built: %s" % len(built))
+        self.assertEqual(len(built), len(set(built)))
+
+
 class MockResource(object):
     """
     Creates a mock resource, with populated many-to-many fields to be used in tests
@@ -425,8 +661,88 @@ class DirectoryListingTest(TestCase):
         self.dir.traverse_folders('/okm:categories/')
 
 
+class RepositoryCrawlerTest(TestCase):
+
+    class MockCrawler(facades.RepositoryCrawler):
+        tree = {
+            '/okm:root': (['/okm:root/a.pdf'], ['/okm:root/One', '/okm:root/Two']),
+            '/okm:root/One': (['/okm:root/One/b.pdf'], ['/okm:root/One/Deeper']),
+            '/okm:root/One/Deeper': (['/okm:root/One/Deeper/c.pdf'], []),
+            '/okm:root/Two': ([], []),
+        }
+
+        def list_folder(self, item):
+            documents, folders = self.tree[item[0]]
+            return [self.node(path) for path in documents], [self.node(path) for path in folders]
+
+        def node(self, path):
+            node = Object()
+            node.path = path
+            return node
+
+    def crawl(self, **kwargs):
+        return [(result.kind, result.node.path, result.depth) for result in self.MockCrawler(**kwargs).crawl('/okm:root/')]
+
+    def test_breadth_first(self):
+        self.assertEqual([('document', '/okm:root/a.pdf', 1),
+                          ('folder', '/okm:root/One', 1),
+                          ('folder', '/okm:root/Two', 1),
+                          ('document', '/okm:root/One/b.pdf', 2),
+                          ('folder', '/okm:root/One/Deeper', 2),
+                          ('document', '/okm:root/One/Deeper/c.pdf', 3)], self.crawl(workers=2))
+
+    def test_max_depth_and_filter(self):
+        results = self.crawl(max_depth=2, path_filter=lambda path: not path.endswith('Two'))
+        self.assertEqual(['/okm:root/a.pdf', '/okm:root/One', '/okm:root/One/b.pdf', '/okm:root/One/Deeper'],
+                         [path for kind, path, depth in results])
+
+
+class SubtreeListingTest(TestCase):
+
+    def setUp(self):
+        self.statements = []
+        self.search = facades.SearchManager()
+        self.search.by_statement = self.by_statement
+
+    def by_statement(self, statement, type):
+        self.statements.append(statement)
+        results = {
+            '/jcr:root/okm:root/One/element(*, okm:folder)': [('folder', '/okm:root/One/Two')],
+            '/jcr:root/okm:root/One/element(*, okm:document)': [('document', '/okm:root/One/a.pdf')],
+            '/jcr:root/okm:root/One/Two//element(*, okm:document)': [('document', '/okm:root/One/Two/Three/b.pdf')],
+        }
+        result = Object()
+        result.item = []
+        for kind, path in results.get(statement, []):
+            item, node = Object(), Object()
+            node.path = path
+            setattr(item, kind, node)
+            result.item.append(item)
+        return result
+
+    def test_iso9075_encode_path(self):
+        self.assertEqual('/okm:root/_x0032_012/EMEA_x0020_North/a_x005F_x0020_b.pdf',
+                         utils.iso9075_encode_path('/okm:root/2012/EMEA North/a_x0020_b.pdf'))
+
+    def test_list_subtree(self):
+        results = [(result.kind, result.node.path, result.depth) for result in self.search.list_subtree('/okm:root/One/')]
+        self.assertEqual([('document', '/okm:root/One/a.pdf', 1),
+                          ('folder', '/okm:root/One/Two', 1),
+                          ('document', '/okm:root/One/Two/Three/b.pdf', 3)], results)
+        self.assertEqual(4, len(self.statements))
+
+    def test_list_subtree_documents_only(self):
+        results = [result.kind for result in self.search.list_subtree('/okm:root/One', folders=False)]
+        self.assertEqual(['document', 'document'], results)
+        self.assertFalse('/jcr:root/okm:root/One/Two//element(*, okm:folder)' in self.statements)
+
+
 class SyncFolderListTest(TestCase):
 
+    class MockFolderList(object):
+        def __init__(self, **kwargs):
+            self.__dict__.update(kwargs)
+
     def setUp(self):
         self.folder_list = sync.SyncFolderList()
 
@@ -434,6 +750,353 @@ class SyncFolderListTest(TestCase):
         paths = self.folder_list.get_list_of_root_paths()
         self.assertTrue(isinstance(paths, list), msg="Expected return value to be a list")
 
+    def test_get_folder_list_objects(self):
+        folder = Object()
+        folder.uuid, folder.author, folder.created = 'abc-123', 'okmAdmin', None
+        folder.hasChilds, folder.path, folder.permissions, folder.subscribed = True, '/okm:categories/Region/EMEA', 15, False
+        folders = Object()
+        folders.item = [Object(), Object()]
+        folders.item[0].folder = folder
+        folders.item[1].document = Object()
+
+        objects = self.folder_list.get_folder_list_objects(folders, self.MockFolderList)
+        self.assertEqual(1, len(objects))
+        self.assertEqual('abc-123', objects[0].okm_uuid)
+        self.assertEqual('/okm:categories/Region/EMEA', objects[0].okm_path)
+        self.assertEqual('region', objects[0].okm_category)
+        self.assertEqual('emea', objects[0].okm_name)
+
+    def test_has_changed(self):
+        row = {'okm_path': u'/okm:categories/Region/EMEA', 'okm_permissions': u'15', 'okm_has_childs': u'True',
+               'okm_category': u'region', 'okm_name': u'emea'}
+        folder = self.MockFolderList(okm_path='/okm:categories/Region/EMEA', okm_permissions=15, okm_has_childs=True,
+                                     okm_category='region', okm_name='emea')
+        self.assertFalse(self.folder_list.has_changed(row, folder))
+        folder.okm_has_childs = False
+        self.assertTrue(self.folder_list.has_changed(row, folder))
+
+    def test_bulk_create_keeps_openkm_created_date(self):
+        field = DateTimeField(auto_now_add=True)
+        field.set_attributes_from_name('okm_created')
+
+        class MockManager(object):
+            def bulk_create(self, objects):
+                # as QuerySet.bulk_create does for each object it inserts
+                for obj in objects:
+                    field.pre_save(obj, True)
+
+        class MockMeta(object):
+            def get_field(self, name):
+                return field
+
+        class MockFolderList(self.MockFolderList):
+            objects = MockManager()
+            _meta = MockMeta()
+
+        created = datetime.datetime(2012, 3, 4, 5, 6, 7)
+        folder = MockFolderList(okm_uuid='abc-123', okm_created=created)
+        self.folder_list.bulk_create([folder], MockFolderList)
+        self.assertEqual(created, folder.okm_created)
+        self.assertTrue(field.auto_now_add)
+
+
+class FolderListIndexTest(TestCase):
+
+    def test_get_path_index(self):
+        self.assertEqual({'okm_category': 'region', 'okm_name': 'latin-america'},
+                         models.get_path_index('/okm:categories/Region/Americas/Latin-America'))
+
+    def test_category_folders_are_not_filed_under_a_category(self):
+        self.assertEqual({'okm_category': None, 'okm_name': 'region'}, models.get_path_index('/okm:categories/Region'))
+        self.assertEqual({'okm_category': None, 'okm_name': 'reports'}, models.get_path_index('/okm:root/Reports'))
+
+
+class CategoryTrieTest(TestCase):
+
+    def setUp(self):
+        self.trie = models.CategoryTrie([
+            ('1', '/okm:categories/Region'),
+            ('2', '/okm:categories/Region/EMEA'),
+            ('3', '/okm:categories/Region/Americas/Latin-America'),
+            ('4', '/okm:categories/Roles/EMEA'),
+        ])
+
+    def test_resolve(self):
+        self.assertEqual([('2', '/okm:categories/Region/EMEA'), ('3', '/okm:categories/Region/Americas/Latin-America')],
+                         self.trie.resolve(['region'], ['emea', 'latin-america']))
+
+    def test_resolve_with_ancestors(self):
+        self.assertEqual([], self.trie.resolve(['region', 'americas'], ['emea']))
+        self.assertEqual(['3'], [uuid for uuid, path in self.trie.resolve(['region', 'americas'], ['latin-america'])])
+
+    def test_get_uuid(self):
+        self.assertEqual('1', self.trie.get_uuid('/okm:categories/Region'))
+        self.assertEqual(None, self.trie.get_uuid('/okm:categories/Tasks'))
+
+
+class BulkSyncTest(TestCase):
+
+    class MockDocument(object):
+        pk = 1
+
+    class FlakySyncer(object):
+        def __init__(self, errors):
+            self.errors = list(errors)
+            self.calls = 0
+
+        def sync(self, document, folderlist_document_class, taxonomy):
+            self.calls += 1
+            if self.errors:
+                raise self.errors.pop(0)
+
+    def setUp(self):
+        self.bulk = sync.BulkDjangoToOpenKm(workers=1, retries=2, backoff=0)
+        self.report = sync.SyncReport()
+
+    def test_network_errors_are_retried(self):
+        syncer = self.FlakySyncer([TransportError('timed out', 503)])
+        self.bulk.sync_document(syncer, self.MockDocument(), None, False, self.report)
+        self.assertEqual(2, syncer.calls)
+        self.assertEqual(1, self.report.synced)
+
+    def test_failures_are_reported(self):
+        syncer = self.FlakySyncer([ValueError('bad document')])
+        self.bulk.sync_document(syncer, self.MockDocument(), None, False, self.report)
+        self.assertEqual(1, syncer.calls)
+        self.assertEqual(0, self.report.synced)
+        self.assertEqual([1], [pk for pk, error in self.report.failures])
+
+
+class BulkPullTest(TestCase):
+
+    def setUp(self):
+        self.bulk = sync.BulkOpenKmToDjango(workers=1, batch_size=10)
+
+    def test_get_tags(self):
+        okm_document = Object()
+        okm_document.keywords = ['emea', None, 'sales']
+        self.assertEqual('emea, sales', sync.OpenKmToDjango().get_tags(okm_document))
+
+    def test_fetch_errors_are_returned(self):
+        class MockDocument(object):
+            okm_path = '/okm:root/missing.pdf'
+
+        class MockPuller(object):
+            class document(object):
+                @staticmethod
+                def get_current_properties(path):
+                    raise ValueError(path)
+
+        self.bulk.local.puller = MockPuller()
+        self.assertTrue(isinstance(self.bulk.fetch(MockDocument()), ValueError))
+
+
+class CategoryPullTest(TestCase):
+
+    class MockRelatedManager(object):
+        def __init__(self, pks):
+            self.pks = set(pks)
+
+        def values_list(self, *fields, **kwargs):
+            return list(self.pks)
+
+        def add(self, *pks):
+            self.pks.update(pks)
+
+        def remove(self, *pks):
+            self.pks.difference_update(pks)
+
+    class MockSyncCategories(object):
+        def get_related_objects(self, related_class, values):
+            objects = {'EMEA': Object(), 'APAC': Object()}
+            objects['EMEA'].pk, objects['APAC'].pk = 1, 2
+            return dict((value, objects[value]) for value in values if value in objects)
+
+    def test_set_related_objects(self):
+        class Region(object):
+            pass
+
+        document = Object()
+        document.region = self.MockRelatedManager([1, 3])
+        puller = sync.OpenKmToDjango()
+        puller.sync_categories = self.MockSyncCategories()
+        added, removed = puller.set_related_objects(document, Region, ['EMEA', 'APAC', 'Unknown'])
+        self.assertEqual((set([2]), set([3])), (added, removed))
+        self.assertEqual(set([1, 2]), document.region.pks)
+
+    def test_map_index(self):
+        self.assertEqual('Industry', sync.SyncCategories.map_index.get_key('Industries'))
+
+
+class PropertyGroupTemplatesTest(TestCase):
+
+    def setUp(self):
+        self.groups = {
+            'okg:customProperties': {
+                'okp:customProperties.title': {'attribute': 'name'},
+                'okp:customProperties.languages': {'attribute': 'languages', 'choices': None},
+            },
+        }
+        self.templates = sync.PropertyGroupTemplates(self.groups)
+
+    def test_fill_values(self):
+        self.assertEqual({'okg:customProperties': {'okp:customProperties.title': ['Title']}},
+                         self.templates.fill_values({'okp:customProperties.title': 'Title', 'okp:other': 'x'}))
+
+    def test_fill_map_leaves_settings_unchanged(self):
+        filled = self.templates.fill_map({'okp:customProperties.title': 'Title'})
+        self.assertEqual({'attribute': 'name', 'value': 'Title'}, filled['okg:customProperties']['okp:customProperties.title'])
+        self.assertEqual({'attribute': 'name'}, self.groups['okg:customProperties']['okp:customProperties.title'])
+
+
+class ChoiceIndexTest(TestCase):
+
+    def test_lookups(self):
+        index = utils.ChoiceIndex(((1, 'Draft'), (2, 'Published'), (3, 'Draft')))
+        self.assertEqual('Published', index.get_label(2))
+        self.assertEqual(1, index.get_key('Draft'))
+        self.assertEqual(False, index.get_key('draft'))
+
+    def test_fold_case(self):
+        index = utils.ChoiceIndex(((1, 'Draft'),), fold_case=True)
+        self.assertEqual(1, index.get_key('DRAFT'))
+
+    def test_set_attributes(self):
+        option = Object()
+        option.label, option.value, option.selected = 'Published', 'published', True
+        document_property = Object()
+        document_property.name, document_property.options = 'okp:customProperties.status', [option]
+        property_map = {'okp:customProperties.status': {'attribute': 'status', 'choices': ((1, 'Draft'), (2, 'Published'))}}
+        document = sync.SyncProperties().set_attributes(property_map, [document_property], Object())
+        self.assertEqual(2, document.status)
+
+
+class DocumentFingerprintTest(TestCase):
+
+    def test_round_trip(self):
+        fingerprint = sync.DocumentFingerprint({'file': 'a', 'keywords': 'b', 'categories': 'c', 'properties': 'd'})
+        parsed = sync.DocumentFingerprint.parse(str(fingerprint))
+        self.assertEqual(fingerprint.hashes, parsed.hashes)
+        self.assertEqual(set(), fingerprint.changed_steps(parsed))
+
+    def test_changed_steps(self):
+        previous = sync.DocumentFingerprint({'file': 'a', 'keywords': 'b', 'categories': 'c', 'properties': 'd'})
+        fingerprint = sync.DocumentFingerprint({'file': 'a', 'keywords': 'x', 'categories': 'c', 'properties': None})
+        self.assertEqual(set(['keywords', 'properties']), fingerprint.changed_steps(previous))
+        self.assertEqual(set(sync.DocumentFingerprint.STEPS), fingerprint.changed_steps(None))
+
+    def test_hash_ignores_dict_order(self):
+        self.assertEqual(sync.DocumentFingerprint.hash({'a': [1], 'b': u'two'}),
+                         sync.DocumentFingerprint.hash(dict([('b', u'two'), ('a', [1])])))
+
+    def test_file_hash_reused_while_stat_unchanged(self):
+        class MockSyncer(sync.DjangoToOpenKm):
+            def __init__(self):
+                self.hashed = 0
+
+            def get_file_stat(self, document):
+                return 'stat'
+
+            def get_file_hash(self, document):
+                self.hashed += 1
+                return 'hash'
+
+            def get_keywords_value(self, document):
+                return 'b'
+
+            get_categories_value = get_properties_value = get_keywords_value
+
+        syncer = MockSyncer()
+        previous = syncer.get_fingerprint(None)
+        self.assertEqual(1, syncer.hashed)
+        fingerprint = syncer.get_fingerprint(None, sync.DocumentFingerprint.parse(str(previous)))
+        self.assertEqual(1, syncer.hashed)
+        self.assertEqual(set(), fingerprint.changed_steps(previous))
+
+    def test_hash_file(self):
+        file_obj = StringIO.StringIO('some content')
+        file_obj.seek(5)
+        self.assertEqual('94e66df8cd09d410c62d9e0dc59d3a884e458e05', utils.hash_file(file_obj, block_size=3))
+        self.assertEqual(5, file_obj.tell())
+
+
+class SyncQueueTest(TestCase):
+
+    def setUp(self):
+        content_type = ContentType.objects.get_for_model(models.OpenKmSyncJob)
+        self.job = models.OpenKmSyncJob.objects.create(content_type=content_type, object_id=1,
+                                                       available_at=datetime.datetime.now())
+
+    def test_lease_is_exclusive(self):
+        self.assertEqual([self.job.pk], [job.pk for job in models.OpenKmSyncJob.objects.lease('one', 10, 60)])
+        self.assertEqual([], models.OpenKmSyncJob.objects.lease('two', 10, 60))
+
+    def test_complete(self):
+        job = models.OpenKmSyncJob.objects.lease('one', 10, 60)[0]
+        models.OpenKmSyncJob.objects.complete(job)
+        self.assertFalse(models.OpenKmSyncJob.objects.filter(pk=job.pk).exists())
+
+    def test_changes_while_running_are_kept(self):
+        job = models.OpenKmSyncJob.objects.lease('one', 10, 60)[0]
+        models.OpenKmSyncJob.objects.filter(pk=job.pk).update(sequence=job.sequence + 1)
+        models.OpenKmSyncJob.objects.complete(job)
+        self.assertEqual([job.pk], [job.pk for job in models.OpenKmSyncJob.objects.lease('two', 10, 60)])
+
+    def test_failed_jobs_are_retried_then_dead(self):
+        job = models.OpenKmSyncJob.objects.lease('one', 10, 60)[0]
+        models.OpenKmSyncJob.objects.fail(job, ValueError('first'), max_attempts=2, backoff=0)
+        job = models.OpenKmSyncJob.objects.lease('one', 10, 60)[0]
+        self.assertEqual(1, job.attempts)
+        models.OpenKmSyncJob.objects.fail(job, ValueError('second'), max_attempts=2, backoff=0)
+        job = models.OpenKmSyncJob.objects.get(pk=job.pk)
+        self.assertEqual(models.OpenKmSyncJob.DEAD, job.status)
+        self.assertEqual(u'second', job.last_error)
+
+    def test_renew_only_held_leases(self):
+        job = models.OpenKmSyncJob.objects.lease('one', 10, 60)[0]
+        self.assertEqual(1, models.OpenKmSyncJob.objects.renew([job], 'one', 600))
+        self.assertEqual(0, models.OpenKmSyncJob.objects.renew([job], 'two', 600))
+        leased_until = models.OpenKmSyncJob.objects.get(pk=job.pk).leased_until
+        self.assertTrue(leased_until > datetime.datetime.now() + datetime.timedelta(seconds=300))
+
+    def test_enqueue_coalesces(self):
+        # any model instance with an okm_path will do as the document
+        models.OpenKmSyncJob.objects.enqueue(self.job, models.OpenKmSyncJob.SYNC)
+        models.OpenKmSyncJob.objects.enqueue(self.job, models.OpenKmSyncJob.DELETE)
+        content_type = ContentType.objects.get_for_model(self.job)
+        jobs = models.OpenKmSyncJob.objects.filter(pending_key=models.OpenKmSyncJob.get_pending_key(content_type, self.job.pk))
+        self.assertEqual([(models.OpenKmSyncJob.DELETE, 1)], [(job.action, job.sequence) for job in jobs])
+
+    def test_pull_is_not_queued(self):
+        class MockPuller(sync.OpenKmToDjango):
+            def keywords(self, document, okm_document):
+                self.enabled = outbound.is_enabled()
+
+            def properties(self, document):
+                pass
+
+            def categories(self, document, okm_document):
+                pass
+
+        configuration = dict(settings.OPENKM['configuration'], SyncQueue=True)
+        with self.settings(OPENKM=dict(settings.OPENKM, configuration=configuration)):
+            self.assertTrue(outbound.is_enabled())
+            puller = MockPuller()
+            puller.execute(None, None)
+            self.assertFalse(puller.enabled)
+
+    def test_push_is_not_queued(self):
+        class MockPusher(sync.DjangoToOpenKm):
+            def sync(self, document, folderlist_document_class, taxonomy=False, force=False):
+                self.enabled = outbound.is_enabled()
+
+        configuration = dict(settings.OPENKM['configuration'], SyncQueue=True)
+        with self.settings(OPENKM=dict(settings.OPENKM, configuration=configuration)):
+            pusher = MockPusher()
+            pusher.execute(None, None)
+            self.assertFalse(pusher.enabled)
+            self.assertTrue(outbound.is_enabled())
+
 
 class FileSystemTest(TestCase):
 
@@ -467,6 +1130,233 @@ class TaxonomyTest(TestCase):
         dependencies = self.taxonomy.generate_path_dependencies(self.folders)
         self.taxonomy.build_path(dependencies)
 
+    def test_build_path_caches_known_folders(self):
+        class MockRepository(object):
+            checked = []
+
+            def has_node(self, path):
+                self.checked.append(path)
+                return path == '/okm:root/Uploads'
+
+        class MockFolder(object):
+            created = []
+
+            def new(self):
+                return Object()
+
+            def create(self, folder):
+                self.created.append(folder.path)
+
+        self.taxonomy.repository = MockRepository()
+        self.taxonomy.folder = MockFolder()
+        self.taxonomy.known_paths = facades.KnownFolderPaths()
+        self.taxonomy.root_path = '/okm:root/Uploads'
+        dependencies = self.taxonomy.generate_path_dependencies(self.folders)
+
+        self.taxonomy.build_path(dependencies)
+        self.assertEqual(['/okm:root/Uploads/EMEA', '/okm:root/Uploads/EMEA/2012', '/okm:root/Uploads/EMEA/2012/Team'],
+                         self.taxonomy.folder.created)
+        self.assertEqual(4, len(self.taxonomy.repository.checked))
+
+        self.taxonomy.build_path(dependencies)
+        self.assertEqual(4, len(self.taxonomy.repository.checked))
+        self.assertEqual(3, len(self.taxonomy.folder.created))
+
+    def test_build_path_rewalks_deleted_known_folders(self):
+        class MockRepository(object):
+            checked = []
+
+            def has_node(self, path):
+                self.checked.append(path)
+                return path == '/okm:root/Uploads'
+
+        class MockFolder(object):
+            created = []
+
+            def new(self):
+                return Object()
+
+            def create(self, folder):
+                parent = folder.path.rsplit('/', 1)[0]
+                if parent != '/okm:root/Uploads' and parent not in self.created:
+                    fault = Object()
+                    fault.detail = [type('PathNotFoundException', (object,), {})()]
+                    raise suds.WebFault(fault, None)
+                self.created.append(folder.path)
+
+        self.taxonomy.repository = MockRepository()
+        self.taxonomy.folder = MockFolder()
+        self.taxonomy.known_paths = facades.KnownFolderPaths()
+        self.taxonomy.root_path = '/okm:root/Uploads'
+        # remembered from before the folders were deleted by someone else
+        self.taxonomy.known_paths.add('/okm:root/Uploads/EMEA')
+        self.taxonomy.known_paths.add('/okm:root/Uploads/EMEA/2012')
+
+        self.taxonomy.build_path(self.taxonomy.generate_path_dependencies(self.folders))
+        self.assertEqual(['/okm:root/Uploads/EMEA', '/okm:root/Uploads/EMEA/2012', '/okm:root/Uploads/EMEA/2012/Team'],
+                         self.taxonomy.folder.created)
+
+
+class StreamingUploadTest(TestCase):
+
+    def setUp(self):
+        self.data = ''.join(chr(i % 256) for i in xrange(100001))
+        self.file_obj = StringIO.StringIO(self.data)
+
+    def test_chunks_concatenate_to_single_encoding(self):
+        chunks = list(utils.iter_base64_chunks(self.file_obj, block_size=300))
+        self.assertTrue(len(chunks) > 1, msg="Expected the file to be read in several blocks")
+        self.assertEqual(''.join(chunks), base64.b64encode(self.data))
+
+    def test_block_size_must_align(self):
+        self.assertRaises(ValueError, lambda: list(utils.iter_base64_chunks(self.file_obj, block_size=100)))
+
+    def test_streaming_body(self):
+        """ The placeholder should be replaced by the encoded file and the length known up front """
+        streaming_transport = transport.StreamingTransport()
+        placeholder = streaming_transport.stream(self.file_obj)
+        message = '<content>%s</content>' % placeholder
+        body = streaming_transport._get_streaming_body(message, [placeholder])
+        sent = ''.join(iter(lambda: body.read(8192), ''))
+        self.assertEqual(sent, '<content>%s</content>' % base64.b64encode(self.data))
+        self.assertEqual(len(body), len(sent))
+
+    def test_failed_send_forgets_stream(self):
+        """ A failed send shouldn't leave the file registered, but the call may register it again """
+        class FailingTransport(transport.StreamingTransport):
+            def u2open(self, u2request):
+                self.sent = u2request.data.read()
+                raise urllib2.URLError('refused')
+
+        streaming_transport = FailingTransport()
+        placeholder = streaming_transport.stream(self.file_obj)
+        streams = streaming_transport.get_streams(['/okm:root/a.pdf', placeholder])
+        request = suds.transport.Request('http://localhost/OKMDocument', '<content>%s</content>' % placeholder)
+        self.assertRaises(urllib2.URLError, streaming_transport.send, request)
+        self.assertEqual(streaming_transport.streams, {})
+
+        streaming_transport.restream(streams)
+        self.assertRaises(urllib2.URLError, streaming_transport.send, request)
+        self.assertEqual(streaming_transport.sent, '<content>%s</content>' % base64.b64encode(self.data))
+        self.assertEqual(streaming_transport.streams, {})
+
+
+class StreamingDownloadTest(TestCase):
+
+    REPLY = '<?xml version="1.0"?><S:Envelope xmlns:S="http://schemas.xmlsoap.org/soap/envelope/"><S:Body>' \
+            '<ns2:getContentResponse xmlns:ns2="http://ws.openkm.com"><return>%s</return>' \
+            '</ns2:getContentResponse></S:Body></S:Envelope>'
+
+    def setUp(self):
+        self.data = ''.join(chr(i % 256) for i in xrange(100001))
+
+    def test_decoder_accepts_unaligned_pieces(self):
+        encoded = base64.encodestring(self.data)
+        decoder = utils.Base64Decoder()
+        decoded = [decoder.decode(encoded[i:i + 7]) for i in xrange(0, len(encoded), 7)]
+        decoder.flush()
+        self.assertEqual(''.join(decoded), self.data)
+
+    def test_iter_base64_content(self):
+        """ The content element should be decoded block by block as the reply is read """
+        reply = StringIO.StringIO(self.REPLY % base64.b64encode(self.data))
+        blocks = list(transport.iter_base64_content(reply, block_size=1024))
+        self.assertTrue(len(blocks) > 1, msg="Expected the content to be decoded in several blocks")
+        self.assertEqual(''.join(blocks), self.data)
+
+
+class MetadataCacheTest(TestCase):
+
+    def setUp(self):
+        self.backend = cache.LocalMetadataCache(timeout=60, max_entries=2)
+        self.metadata = cache.MetadataCache(self.backend)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.backend.set('a', 1)
+        self.backend.set('b', 2)
+        self.backend.get('a')
+        self.backend.set('c', 3)
+        self.assertEqual(self.backend.get('b'), None, msg="Least recently used entry was not evicted")
+        self.assertEqual(self.backend.get('a'), 1)
+        self.assertEqual(self.backend.get('c'), 3)
+
+    def test_expired_entries_are_not_returned(self):
+        self.backend.timeout = -1
+        self.backend.set('a', 1)
+        self.assertEqual(self.backend.get('a'), None)
+
+    def test_invalidate(self):
+        """ Invalidating a path should drop both its properties and the uuid lookup """
+        path = '/okm:root/Uploads/notes.pdf'
+        self.metadata.set(cache.MetadataCache.PATH, 'uuid-1', path)
+        self.metadata.set(cache.MetadataCache.PROPERTIES, path, 'properties')
+        self.metadata.invalidate(path)
+        self.assertEqual(self.metadata.get(cache.MetadataCache.PATH, 'uuid-1'), None)
+        self.assertEqual(self.metadata.get(cache.MetadataCache.PROPERTIES, path), None)
+
+    def test_django_cache_clear(self):
+        backend = cache.DjangoMetadataCache(timeout=60)
+        backend.set(u'path:uuid-1', u'/okm:root/Uploads/notes.pdf')
+        self.assertEqual(u'/okm:root/Uploads/notes.pdf', backend.get(u'path:uuid-1'))
+        backend.clear()
+        self.assertEqual(None, backend.get(u'path:uuid-1'))
+
+
+class RangeRequestTest(TestCase):
+
+    def test_parse_range_header(self):
+        self.assertEqual(utils.parse_range_header('bytes=0-499', 1000), (0, 499))
+        self.assertEqual(utils.parse_range_header('bytes=500-', 1000), (500, 999))
+        self.assertEqual(utils.parse_range_header('bytes=-200', 1000), (800, 999))
+        self.assertEqual(utils.parse_range_header('bytes=900-5000', 1000), (900, 999))
+
+    def test_unsupported_ranges_are_ignored(self):
+        self.assertEqual(utils.parse_range_header(None, 1000), None)
+        self.assertEqual(utils.parse_range_header('bytes=0-1,5-6', 1000), None)
+        self.assertEqual(utils.parse_range_header('bytes=a-b', 1000), None)
+
+    def test_unsatisfiable_range(self):
+        self.assertRaises(ValueError, utils.parse_range_header, 'bytes=1000-', 1000)
+        self.assertRaises(ValueError, utils.parse_range_header, 'bytes=5-4', 1000)
+
+    def test_slice_blocks(self):
+        blocks = ['abc', 'defg', 'hij']
+        self.assertEqual(''.join(utils.slice_blocks(iter(blocks), 2, 8)), 'cdefgh')
+
+
+class ContentCacheTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.content_cache = cache.ContentCache(self.root, max_size=10)
+
+    def test_store_and_open(self):
+        blocks = list(self.content_cache.store('uuid-1', '1.0', iter(['abc', 'def'])))
+        self.assertEqual(blocks, ['abc', 'def'], msg="Blocks should pass through unchanged")
+        self.assertEqual(self.content_cache.open('uuid-1', '1.0').read(), 'abcdef')
+        self.assertEqual(self.content_cache.open('uuid-1', '1.1'), None, msg="Other versions should miss")
+
+    def test_incomplete_stream_is_not_cached(self):
+        stream = self.content_cache.store('uuid-1', '1.0', iter(['abc', 'def']))
+        stream.next()
+        stream.close()
+        self.assertEqual(self.content_cache.open('uuid-1', '1.0'), None)
+        self.assertEqual(os.listdir(self.root), [], msg="Temporary file was left behind")
+
+    def test_cached_files_are_readable_by_others(self):
+        self.content_cache.fill('uuid-1', '1.0', ['abc']).close()
+        self.assertEqual(0644, os.stat(self.content_cache.get_path('uuid-1', '1.0')).st_mode & 0777)
+
+    def test_least_recently_used_body_is_evicted(self):
+        self.content_cache.fill('uuid-1', '1.0', ['123456']).close()
+        os.utime(self.content_cache.get_path('uuid-1', '1.0'), (0, 0))
+        self.content_cache.fill('uuid-2', '1.0', ['123456']).close()
+        self.assertEqual(self.content_cache.open('uuid-1', '1.0'), None)
+        self.assertEqual(self.content_cache.open('uuid-2', '1.0').read(), '123456')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
 
 def get_content_for_upload():
     """
@@ -0,0 +1,227 @@
+"""
+suds transports used by the client library
+"""
+import uuid
+import logging
+import urllib2
+import itertools
+from xml.parsers import expat
+
+from suds.client import SoapClient
+from suds.transport import Request, TransportError
+from suds.transport.https import HttpAuthenticated
+
+import utils
+
+# size of the blocks read from the socket when parsing a streamed reply
+REPLY_BLOCK_SIZE = 64 * 1024
+
+
+class StreamingBody(object):
+    """
+    File like request body which produces the SOAP envelope and the base64 encoded file
+    content a block at a time as httplib reads it, so the encoded file is never held in memory
+    """
+
+    def __init__(self, parts, length):
+        """
+        :param parts: iterable of strings which make up the body
+        :param length: int the total length of the body, sent as Content-Length
+        """
+        self.parts = iter(parts)
+        self.length = length
+        self._chunk = ''
+        self._position = 0
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._position >= len(self._chunk):
+                try:
+                    self._chunk, self._position = self.parts.next(), 0
+                except StopIteration:
+                    break
+                continue
+            end = len(self._chunk) if size < 0 else self._position + size
+            piece = self._chunk[self._position:end]
+            self._position += len(piece)
+            if size > 0:
+                size -= len(piece)
+            pieces.append(piece)
+        return ''.join(pieces)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return '<streamed SOAP body of %d bytes>' % self.length
+
+
+class StreamingTransport(HttpAuthenticated):
+    """
+    Transport which streams file content into the SOAP request.
+    stream() registers a file and returns a placeholder string.  suds marshals the placeholder
+    like any other string and send() splices the base64 encoded file in its place as the
+    request is written to the socket
+    """
+    PLACEHOLDER = 'openkm-stream-%s'
+
+    def __init__(self, **kwargs):
+        HttpAuthenticated.__init__(self, **kwargs)
+        self.streams = {}
+
+    def stream(self, file_obj):
+        """
+        :param file_obj: file like object, read from its current position
+        :returns string to be passed as the content of a create or setContent call
+        """
+        size = utils.get_file_size(file_obj)
+        if size is None:
+            # without a length there is no Content-Length, so encode in memory instead
+            logging.debug('Size of %s unknown, encoding in memory', file_obj)
+            return utils.make_file_java_byte_array_compatible(file_obj)
+
+        placeholder = self.PLACEHOLDER % uuid.uuid4().hex
+        self.streams[placeholder] = (file_obj, file_obj.tell(), size)
+        return placeholder
+
+    def send(self, request):
+        placeholders = [placeholder for placeholder in self.streams if placeholder in request.message]
+        if not placeholders:
+            return HttpAuthenticated.send(self, request)
+
+        placeholders.sort(key=request.message.index)
+        message = request.message
+        try:
+            request.message = self._get_streaming_body(message, placeholders)
+            request.headers['Content-Length'] = str(len(request.message))
+            return HttpAuthenticated.send(self, request)
+        except:
+            request.message = message
+            raise
+        finally:
+            # a call retried after a failure, eg. after a session renewal, registers them again
+            for placeholder in placeholders:
+                del self.streams[placeholder]
+
+    def get_streams(self, values):
+        """
+        :param values: iterable of call arguments
+        :returns dict of placeholder : stream for the values which are registered placeholders
+        """
+        return dict((value, self.streams[value]) for value in values
+                    if isinstance(value, basestring) and value in self.streams)
+
+    def restream(self, streams):
+        """
+        Registers streams again, rewound, so that a call which sent them can be retried
+        :param streams: dict as returned by get_streams()
+        """
+        for placeholder, (file_obj, position, size) in streams.items():
+            file_obj.seek(position)
+            self.streams[placeholder] = (file_obj, position, size)
+
+    def open_reply(self, request):
+        """
+        Sends a request like send() but returns the open reply rather than reading it
+        :returns file like object
+        """
+        self.addcredentials(request)
+        u2request = urllib2.Request(request.url, request.message, request.headers)
+        self.addcookies(u2request)
+        self.proxy = self.options.proxy
+        try:
+            fp = self.u2open(u2request)
+        except urllib2.HTTPError, e:
+            raise TransportError(e.msg, e.code, e.fp)
+        self.getcookies(fp, u2request)
+        return fp
+
+    def _get_streaming_body(self, message, placeholders):
+        parts = []
+        length = 0
+        for placeholder in placeholders:
+            head, message = message.split(placeholder, 1)
+            file_obj, position, size = self.streams[placeholder]
+            parts.append([head])
+            parts.append(utils.iter_base64_chunks(file_obj))
+            length += len(head) + utils.base64_length(size)
+        parts.append([message])
+        length += len(message)
+        return StreamingBody(itertools.chain(*parts), length)
+
+
+class StreamingSoapClient(SoapClient):
+    """
+    Builds and sends a SOAP request through suds, but hands back the unread reply
+    """
+
+    def open(self, args, kwargs):
+        binding = self.method.binding.input
+        soapenv = binding.get_message(self.method, args, kwargs)
+        request = Request(self.location(), soapenv.plain().encode('utf-8'))
+        request.headers = self.headers()
+        try:
+            return self.options.transport.open_reply(request)
+        except TransportError, e:
+            # raises WebFault when the reply is a SOAP fault
+            self.failed(binding, e)
+            raise
+
+
+class StreamingMethod(object):
+    """
+    Callable wrapping a suds method, eg. client.service.getContent, which returns the open
+    reply instead of the unmarshalled result.  Requires a client using StreamingTransport
+    """
+
+    def __init__(self, method):
+        self.method = method
+
+    def __call__(self, *args, **kwargs):
+        return StreamingSoapClient(self.method.client, self.method.method).open(args, kwargs)
+
+
+def iter_base64_content(reply, element_name='return', block_size=REPLY_BLOCK_SIZE):
+    """
+    Parses a SOAP reply as it is read and yields the decoded content of its base64 element
+    :param reply: file like object, as returned by StreamingMethod
+    :param element_name: string local name of the element holding the content
+    :return generator of binary strings
+    """
+    decoder = utils.Base64Decoder()
+    decoded = []
+    state = {'inside': False}
+
+    def start_element(name, attributes):
+        if name.split(' ')[-1] == element_name:
+            state['inside'] = True
+
+    def end_element(name):
+        if name.split(' ')[-1] == element_name:
+            state['inside'] = False
+
+    def character_data(text):
+        if state['inside']:
+            decoded.append(decoder.decode(text))
+
+    parser = expat.ParserCreate(namespace_separator=' ')
+    parser.returns_unicode = False
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    try:
+        while True:
+            block = reply.read(block_size)
+            parser.Parse(block, not block)
+            for data in decoded:
+                if data:
+                    yield data
+            del decoded[:]
+            if not block:
+                break
+        decoder.flush()
+    finally:
+        reply.close()
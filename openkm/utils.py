@@ -1,22 +1,87 @@
+import os
+import re
 import base64
+import hashlib
 
 import suds
 
 """
 Some useful helper and decorator functions
 """
+# size of the blocks read when base64 encoding a file.  Must be a multiple of 3 so that
+# each block encodes without padding and the encoded blocks can simply be concatenated
+BASE64_BLOCK_SIZE = 3 * 256 * 1024
+
 def make_file_java_byte_array_compatible(file_obj):
     """ 
     Reads in a file and converts it to a format accepted as Java byte array 
     :param file object
     :return string
     """
-    encoded_data = base64.b64encode(file_obj.read())
-    strg = ''
-    for i in xrange((len(encoded_data)/40)+1):
-        strg += encoded_data[i*40:(i+1)*40]
-        
-    return strg
+    return ''.join(iter_base64_chunks(file_obj))
+
+def iter_base64_chunks(file_obj, block_size=BASE64_BLOCK_SIZE):
+    """
+    Reads a file in fixed size blocks and yields each block base64 encoded, so a file can be
+    encoded without holding it in memory
+    :param file_obj: file like object
+    :param block_size: int, a multiple of 3
+    :return generator of strings which concatenate to the base64 encoding of the file
+    """
+    if block_size % 3:
+        raise ValueError('block_size must be a multiple of 3')
+    while True:
+        data = read_block(file_obj, block_size)
+        if not data:
+            break
+        yield base64.b64encode(data)
+
+def read_block(file_obj, size):
+    """
+    Reads size bytes from a file, only returning fewer at the end of the file.
+    (read() on pipes and sockets may return short reads, which would break the 3 byte alignment)
+    """
+    data = file_obj.read(size)
+    while data and len(data) < size:
+        more = file_obj.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+def base64_length(size):
+    """ Length of the base64 encoding of size bytes """
+    return 4 * ((size + 2) // 3)
+
+def get_file_size(file_obj):
+    """
+    :return the number of bytes left to read in file_obj, or None if it can't be determined
+    """
+    try:
+        position = file_obj.tell()
+        file_obj.seek(0, os.SEEK_END)
+        size = file_obj.tell()
+        file_obj.seek(position)
+        return size - position
+    except (AttributeError, IOError, ValueError):
+        return None
+
+def hash_file(file_obj, block_size=BASE64_BLOCK_SIZE):
+    """
+    :return the hex SHA-1 of the whole file, leaving file_obj at its current position
+    """
+    position = file_obj.tell()
+    file_obj.seek(0)
+    digest = hashlib.sha1()
+    try:
+        while True:
+            data = file_obj.read(block_size)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        file_obj.seek(position)
+    return digest.hexdigest()
 
 def java_byte_array_to_binary(file_obj):
     """ 
@@ -24,12 +89,125 @@ def java_byte_array_to_binary(file_obj):
     :param java byte array as string (pass in as a file like object, can use StringIO)
     :return binary string
     """
-    decoded_data = base64.b64decode(file_obj.read())
-    strg = ''
-    for i in xrange((len(decoded_data)/40)+1):
-        strg += decoded_data[i*40:(i+1)*40]
-        
-    return strg
+    return base64.b64decode(file_obj.read())
+
+
+class Base64Decoder(object):
+    """
+    Decodes base64 text which arrives in pieces of any length, eg. from an XML parser
+    """
+
+    def __init__(self):
+        self.remainder = ''
+
+    def decode(self, text):
+        """
+        :param text: string, the next piece of the base64 text
+        :return the binary string decoded so far
+        """
+        text = self.remainder + ''.join(text.split())
+        usable = len(text) - len(text) % 4
+        self.remainder = text[usable:]
+        return base64.b64decode(text[:usable])
+
+    def flush(self):
+        if self.remainder:
+            raise ValueError('base64 content ended mid-block')
+        return ''
+
+
+def slice_blocks(blocks, start, stop):
+    """
+    Yields bytes [start, stop) of a stream of binary blocks, closing the stream once stop is reached
+    :param blocks: iterable of binary strings
+    """
+    position = 0
+    try:
+        for block in blocks:
+            end = position + len(block)
+            if end > start:
+                yield block[max(start - position, 0):stop - position]
+            position = end
+            if position >= stop:
+                break
+    finally:
+        if hasattr(blocks, 'close'):
+            blocks.close()
+
+def iter_file(file_obj, start=0, stop=None, block_size=64 * 1024):
+    """
+    Yields bytes [start, stop) of a file in blocks, closing the file afterwards
+    """
+    try:
+        file_obj.seek(start)
+        remaining = None if stop is None else stop - start
+        while remaining is None or remaining > 0:
+            block = file_obj.read(block_size if remaining is None else min(block_size, remaining))
+            if not block:
+                break
+            if remaining is not None:
+                remaining -= len(block)
+            yield block
+    finally:
+        file_obj.close()
+
+def parse_range_header(header, size):
+    """
+    Parses an HTTP Range header.  Only single byte ranges are supported
+    :param header: string eg. 'bytes=0-499', 'bytes=500-' or 'bytes=-500'
+    :param size: int size of the entity
+    :return (start, end) inclusive, or None if the header is absent or not supported
+    :raises ValueError if the range can't be satisfied
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        first = int(first) if first else None
+        last = int(last) if last else None
+    except ValueError:
+        return None
+
+    if first is None:
+        # suffix range, the last n bytes
+        if not last:
+            raise ValueError('Unsatisfiable range %s' % header)
+        return max(size - last, 0), size - 1
+    if first >= size or (last is not None and last < first):
+        raise ValueError('Unsatisfiable range %s' % header)
+    if last is None or last >= size:
+        last = size - 1
+    return first, last
+
+class ChoiceIndex(object):
+    """
+    Forward and reverse lookups of a Django style choices sequence, eg. ((1, 'Draft'), ...),
+    built once so a lookup doesn't scan the choices.  Where a label appears more than once
+    the first key wins
+    :param fold_case: bool labels are matched regardless of case
+    """
+
+    def __init__(self, choices, fold_case=False):
+        self.fold_case = fold_case
+        self.labels = {}
+        self.keys = {}
+        for key, label in choices:
+            self.labels.setdefault(key, label)
+            self.keys.setdefault(self._fold(label), key)
+
+    def get_label(self, key, default=None):
+        return self.labels.get(key, default)
+
+    def get_key(self, label, default=False):
+        """ :returns the key of label, or default (False, as find_key) if there isn't one """
+        return self.keys.get(self._fold(label), default)
+
+    def _fold(self, label):
+        if self.fold_case and isinstance(label, basestring):
+            return label.lower()
+        return label
 
 def find_key(dic, val):
     """return the key of dictionary dic given the value"""
@@ -77,6 +255,31 @@ def remove_trailing_slash(str):
     else:
         return str
 
+ISO9075_ESCAPE_PATTERN = re.compile('_x[0-9A-Fa-f]{4}_')
+
+def iso9075_encode(name):
+    """
+    Encodes a node name for use in a JCR XPath statement, eg. '2012' becomes '_x0032_012'
+    and 'EMEA North' becomes 'EMEA_x0020_North'
+    """
+    encoded = []
+    for i, char in enumerate(name):
+        if char == '_' and ISO9075_ESCAPE_PATTERN.match(name, i):
+            # an underscore which would otherwise read as the start of an escape
+            encoded.append('_x005F_')
+        elif char.isalpha() or char == '_' or (i and (char.isdigit() or char in '.-')):
+            encoded.append(char)
+        else:
+            encoded.append('_x%04X_' % ord(char))
+    return ''.join(encoded)
+
+def iso9075_encode_path(path):
+    """
+    Encodes each name in a repository path for use in a JCR XPath statement.  Prefixed names,
+    eg. okm:root, are left as they are
+    """
+    return '/'.join(name if ':' in name else iso9075_encode(name) for name in path.split('/'))
+
 def remove_none_elements_from_list(list):
     return [e for e in list if e != None]
 
@@ -1,22 +1,177 @@
 import os
+import calendar
 import StringIO
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 
-import client, utils
+import cache, client, utils
 
 def get_document_by_uuid(request, uuid):
     """
-    Returns a document from OpenKM
+    Returns a document from OpenKM, streaming it to the browser as it is decoded.
+    Supports conditional GETs, answered from the document meta data alone, and single
+    byte Range requests.  When the content cache is enabled, versions already fetched are
+    served from disk
     """
-    # Get the file object and convert the string back to binary
-    file_obj, doc_meta = get_document_buffer_by_uuid(uuid)
-    document = utils.java_byte_array_to_binary(file_obj)
-    file_name = os.path.basename(doc_meta.path)
-    
+    document = client.Document()
+    document_path = document.get_path(uuid)
+    doc_meta = document.get_properties(document_path)
+    etag = get_document_etag(doc_meta)
+    last_modified = get_document_last_modified(doc_meta)
+
+    if is_not_modified(request, etag, last_modified):
+        return set_validators(HttpResponseNotModified(), etag, last_modified)
+
+    cached_file = get_cached_content(request, document, document_path, doc_meta)
+    if cached_file and settings.OPENKM['configuration'].get('ContentCacheSendfileHeader'):
+        # the front end server sends the file, and handles any Range request itself
+        response = get_sendfile_response(cached_file, doc_meta)
+        return set_validators(response, etag, last_modified)
+
+    size = os.fstat(cached_file.fileno()).st_size if cached_file else get_document_size(doc_meta)
+    try:
+        byte_range = get_requested_range(request, etag, size)
+    except ValueError:
+        if cached_file:
+            cached_file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%s' % size
+        return response
+
+    start, stop = (byte_range[0], byte_range[1] + 1) if byte_range else (0, size)
+    if cached_file:
+        content = utils.iter_file(cached_file, start, stop)
+    else:
+        content = document.get_content_stream(document_path, False)
+        if byte_range:
+            content = utils.slice_blocks(content, start, stop)
+        elif cache.content is not None and get_document_version(doc_meta):
+            content = cache.content.store(doc_meta.uuid, get_document_version(doc_meta), content)
+
+    if byte_range:
+        response = StreamingHttpResponse(content, status=206, content_type=doc_meta.mimeType)
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, stop - 1, size)
+        response['Content-Length'] = stop - start
+    else:
+        response = StreamingHttpResponse(content, content_type=doc_meta.mimeType)
+        if size is not None:
+            response['Content-Length'] = size
+
     # set the headers and return the file
-    response = HttpResponse(document, doc_meta.mimeType)
-    response['Content-Disposition'] = 'attachment; filename=%s' % file_name
+    response['Content-Disposition'] = get_content_disposition(doc_meta)
+    if size is not None:
+        response['Accept-Ranges'] = 'bytes'
+    return set_validators(response, etag, last_modified)
+
+
+def get_cached_content(request, document, document_path, doc_meta):
+    """
+    Returns the current version of the document from the content cache, opened for reading,
+    or None.  A Range request for a version which isn't cached fetches it into the cache first,
+    so the range can be served from disk
+    """
+    version = get_document_version(doc_meta)
+    if cache.content is None or not version:
+        return None
+    cached_file = cache.content.open(doc_meta.uuid, version)
+    if cached_file is None and request.META.get('HTTP_RANGE'):
+        content = document.get_content_stream(document_path, False)
+        cached_file = cache.content.fill(doc_meta.uuid, version, content)
+    return cached_file
+
+
+def get_sendfile_response(cached_file, doc_meta):
+    """
+    Hands a cached file to the front end server, eg. with X-Sendfile or X-Accel-Redirect
+    """
+    configuration = settings.OPENKM['configuration']
+    path = cached_file.name
+    cached_file.close()
+    if configuration.get('ContentCacheSendfilePrefix'):
+        path = configuration['ContentCacheSendfilePrefix'] + os.path.basename(path)
+    response = HttpResponse(content_type=doc_meta.mimeType)
+    response[configuration['ContentCacheSendfileHeader']] = path
+    response['Content-Disposition'] = get_content_disposition(doc_meta)
+    return response
+
+
+def get_content_disposition(doc_meta):
+    return 'attachment; filename=%s' % os.path.basename(doc_meta.path)
+
+
+def get_document_stream_by_uuid(uuid):
+    """
+    Returns a generator of the document content and document meta data from OpenKM
+    """
+    document = client.Document()
+    document_path = document.get_path(uuid)
+    doc_meta = document.get_properties(document_path)
+    return document.get_content_stream(document_path, False), doc_meta
+
+
+def get_document_size(doc_meta):
+    """ The size in bytes of the current version, if OpenKM returned it """
+    try:
+        return int(doc_meta.actualVersion.size)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def get_document_version(doc_meta):
+    try:
+        return doc_meta.actualVersion.name
+    except AttributeError:
+        return None
+
+
+def get_document_etag(doc_meta):
+    """ A strong ETag which changes whenever a new version of the document is checked in """
+    version = get_document_version(doc_meta)
+    if not version:
+        return None
+    return quote_etag('%s-%s' % (doc_meta.uuid, version))
+
+
+def get_document_last_modified(doc_meta):
+    """ :returns seconds since the epoch, or None """
+    last_modified = getattr(doc_meta, 'lastModified', None)
+    if not last_modified:
+        return None
+    return calendar.timegm(last_modified.utctimetuple())
+
+
+def is_not_modified(request, etag, last_modified):
+    """ True if the browser's cached copy, described by the conditional headers, is current """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag is not None and ('*' in etags or etag in etags or etag.strip('"') in etags)
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    return last_modified is not None and if_modified_since is not None and last_modified <= if_modified_since
+
+
+def get_requested_range(request, etag, size):
+    """
+    :returns (start, end) of the byte range to send, or None to send the whole document
+    :raises ValueError if the range can't be satisfied
+    """
+    if size is None:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        # the browser's partial copy is of another version
+        return None
+    return utils.parse_range_header(request.META.get('HTTP_RANGE'), size)
+
+
+def set_validators(response, etag, last_modified):
+    if etag:
+        response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
     return response
 
 